@@ -368,11 +368,20 @@ class OpenSIPSCLI(cmd.Cmd, object):
         module = line[0] if line else None
         if len(line) < 2:
             return module, None, [], []
+        # modifiers given as `--opt value` also take the following token
+        try:
+            value_modifiers = self.modules[module][0].__get_value_modifiers__()
+        except (AttributeError, KeyError):
+            value_modifiers = None
+        value_modifiers = value_modifiers or []
         paramIndex = 1
         while paramIndex < len(line):
             if line[paramIndex][0] != "-":
                 break
+            if line[paramIndex] in value_modifiers:
+                paramIndex = paramIndex + 1
             paramIndex = paramIndex + 1
+        paramIndex = min(paramIndex, len(line))
         if paramIndex == 1:
             modifiers = []
             command = line[1]
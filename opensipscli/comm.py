@@ -30,10 +30,24 @@ def initialize():
     comm_handler = OpenSIPSMI(comm_type, **cfg.to_dict())
     valid()
 
-def execute(cmd, params=[], silent=False):
+def get_handler(instance=None):
+    """
+    returns a MI handler for the given configuration instance
+    """
+    if instance is None or instance == cfg.current_instance:
+        return comm_handler
+    if not cfg.has_instance(instance):
+        logger.error("instance '{}' not found!".format(instance))
+        return None
+    options = cfg.to_dict(instance)
+    return OpenSIPSMI(options['communication_type'], **options)
+
+def execute(cmd, params=[], silent=False, handler=None):
     global comm_handler
+    if handler is None:
+        handler = comm_handler
     try:
-        ret = comm_handler.execute(cmd, params)
+        ret = handler.execute(cmd, params)
     except OpenSIPSMIException as ex:
         if not silent:
             logger.error("command '{}' returned: {}".format(cmd, ex))
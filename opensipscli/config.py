@@ -142,20 +142,20 @@ class OpenSIPSCLIConfig:
             else:
                 return val
 
-    def to_dict(self):
+    def to_dict(self, instance=None):
+        # dynamic options only apply to the current instance
+        if instance is None:
+            instance = self.current_instance
         temp = defaults.DEFAULT_VALUES.copy()
         temp.update(self.config.defaults())
 
-        if not self.config.has_section(self.current_instance):
-            temp.update(self.custom_options)
-            temp.update(self.dynamic_options)
-            return temp
-
-        for option in self.config.options(self.current_instance):
-            temp[option] = self.config.get(self.current_instance, option)
+        if self.config.has_section(instance):
+            for option in self.config.options(instance):
+                temp[option] = self.config.get(instance, option)
 
         temp.update(self.custom_options)
-        temp.update(self.dynamic_options)
+        if instance == self.current_instance:
+            temp.update(self.dynamic_options)
         return temp
 
 
@@ -19,11 +19,14 @@
 
 from opensipscli.logger import logger
 from opensipscli.config import cfg
+from contextlib import contextmanager
 import re
 
 try:
     import sqlalchemy
     from sqlalchemy import Column, Date, Integer, String, Boolean, text
+    from sqlalchemy import table as sql_table, column, literal_column, \
+            bindparam, and_, tuple_
     try:
         from sqlalchemy.orm import declarative_base  # SA 1.4+
     except ImportError:
@@ -193,6 +196,15 @@ class DBURL(object):
 def make_url(url_string):
     return DBURL(url_string)
 
+def select_columns(columns):
+    """
+    builds a SELECT of columns, for all the supported SQLAlchemy versions
+    """
+    # SA 1.4 accepts, and SA 2.0 requires, the columns as positional args
+    if tuple(int(v) for v in sqlalchemy.__version__.split(".")[:2]) >= (1, 4):
+        return sqlalchemy.select(*columns)
+    return sqlalchemy.select(columns)
+
 class osdb(object):
     """
     Class: object store database
@@ -207,6 +219,11 @@ class osdb(object):
         self.Session = sessionmaker()
         self.__engine = None
         self.__conn = None
+        # statements built for each (operation, table, columns), so that
+        # they are only compiled once by SQLAlchemy and can be reused
+        self.__statements = {}
+        # whether the non-transactional Oracle blocks were already reported
+        self.__warned_transaction = False
 
 	    # TODO: do this only for SQLAlchemy
         try:
@@ -477,10 +494,20 @@ class osdb(object):
         if not self.__conn:
             raise osdbError("connection not available")
 
-        where_str = self.get_where(filter_keys)
-        statement = "DELETE FROM {}{}".format(table, where_str)
+        rows = filter_keys if type(filter_keys) == list else [filter_keys]
+        columns = tuple(rows[0].keys()) if rows[0] else ()
+        key = ("delete", table, columns)
+        statement = self.__statements.get(key)
+        if statement is None:
+            statement = sql_table(table).delete()
+            where = self.get_where(columns)
+            if where is not None:
+                statement = statement.where(where)
+            self.__statements[key] = statement
+        params = self.get_where_params(rows)
         try:
-            self.__conn.execute(text(statement))
+            self.__conn.execute(statement,
+                    params if type(filter_keys) == list else params[0])
         except sqlalchemy.exc.SQLAlchemyError as ex:
             logger.error("cannot execute query: {}".format(statement))
             logger.error(ex)
@@ -658,13 +685,47 @@ class osdb(object):
         elif type(fields) != list:
             fields = [ fields ]
 
-        where_str = self.get_where(filter_keys)
-        statement = "SELECT {} FROM {}{}".format(
-                ", ".join(fields),
-                table,
-                where_str)
+        columns = tuple(filter_keys.keys()) if filter_keys else ()
+        key = ("find", table, tuple(fields), columns)
+        statement = self.__statements.get(key)
+        if statement is None:
+            # fields may also be expressions, such as count(*)
+            statement = select_columns([literal_column(f) for f in fields]).\
+                    select_from(sql_table(table))
+            where = self.get_where(columns)
+            if where is not None:
+                statement = statement.where(where)
+            self.__statements[key] = statement
+        try:
+            result = self.__conn.execute(statement,
+                    self.get_where_params([filter_keys])[0])
+        except sqlalchemy.exc.SQLAlchemyError as ex:
+            logger.error("cannot execute query: {}".format(statement))
+            logger.error(ex)
+            return None
+        return result
+
+    def find_many(self, table, fields, keys, rows):
+        """
+        match fields in a given table, for the entries whose keys have the
+        same values as any of the rows, in a single query
+        """
+        if not self.__conn:
+            raise osdbError("connection not available")
+        if type(fields) != list:
+            fields = [ fields ]
+
+        key = ("find_many", table, tuple(fields), tuple(keys))
+        statement = self.__statements.get(key)
+        if statement is None:
+            statement = select_columns([literal_column(f) for f in fields]).\
+                    select_from(sql_table(table)).where(
+                            tuple_(*[column(k) for k in keys]).in_(
+                                bindparam("w_in", expanding=True)))
+            self.__statements[key] = statement
+        values = [tuple(row[k] for k in keys) for row in rows]
         try:
-            result = self.__conn.execute(text(statement))
+            result = self.__conn.execute(statement, {"w_in": values})
         except sqlalchemy.exc.SQLAlchemyError as ex:
             logger.error("cannot execute query: {}".format(statement))
             logger.error(ex)
@@ -679,22 +740,19 @@ class osdb(object):
 
     def get_where(self, filter_keys):
         """
-        construct a sql 'where clause' from given filter keys
-        """
-        if filter_keys:
-            where_str = ""
-            for k, v in filter_keys.items():
-                where_str += " AND {} = ".format(k)
-                if type(v) == int:
-                    where_str += str(v)
-                else:
-                    where_str += "'{}'".format(
-                            v.translate(str.maketrans({'\'': '\\\''})))
-            if where_str != "":
-                where_str = " WHERE " + where_str[5:]
-        else:
-            where_str = ""
-        return where_str
+        construct a sql 'where clause' from given filter keys, with a bound
+        parameter for the value of each of them
+        """
+        if not filter_keys:
+            return None
+        return and_(*[column(k) == bindparam("w_" + k) for k in filter_keys])
+
+    def get_where_params(self, rows):
+        """
+        returns the parameters bound by get_where() for each of the rows
+        """
+        return [{"w_" + k: v for k, v in row.items()} if row else {}
+                for row in rows]
 
     def get_role(self, role_name="opensips"):
         """
@@ -781,18 +839,18 @@ class osdb(object):
         if not self.__conn:
             raise osdbError("connection not available")
 
-        values = ""
-        for v in keys.values():
-            values += ", "
-            if type(v) == int:
-                values += str(v)
-            else:
-                values += "'{}'".format(
-                        v.translate(str.maketrans({'\'': '\\\''})))
-        statement = "INSERT INTO {} ({}) VALUES ({})".format(
-                table, ", ".join(keys.keys()), values[2:])
+        # a list of rows, all with the same keys, is inserted in one batch
+        rows = keys if type(keys) == list else [keys]
+        columns = tuple(rows[0].keys())
+        key = ("insert", table, columns)
+        statement = self.__statements.get(key)
+        if statement is None:
+            statement = sql_table(table, *[column(c) for c in columns]).\
+                    insert().values({c: bindparam(c) for c in columns})
+            self.__statements[key] = statement
         try:
-            result = self.__conn.execute(text(statement))
+            result = self.__conn.execute(statement,
+                    rows if type(keys) == list else keys)
         except sqlalchemy.exc.SQLAlchemyError as ex:
             logger.error("cannot execute query: {}".format(statement))
             logger.error(ex)
@@ -865,6 +923,32 @@ class osdb(object):
 
         return dict
 
+    @contextmanager
+    def transaction(self):
+        """
+        runs the statements of the block in a single transaction; since the
+        connection is in autocommit mode, the transaction is explicit
+        """
+        if not self.__conn:
+            raise osdbError("connection not available")
+        # Oracle has no explicit BEGIN, statements are committed one by one
+        if self.dialect == "oracle":
+            if not self.__warned_transaction:
+                logger.warning("Oracle does not support explicit transactions "
+                        "in autocommit mode: the statements are committed "
+                        "one by one")
+                self.__warned_transaction = True
+            yield
+            return
+        self.__conn.execute(text("BEGIN"))
+        try:
+            yield
+        except BaseException:
+            # an interrupted block must not be left half committed either
+            self.__conn.execute(text("ROLLBACK"))
+            raise
+        self.__conn.execute(text("COMMIT"))
+
     def update(self, table, update_keys, filter_keys=None):
         """
         update table
@@ -873,19 +957,32 @@ class osdb(object):
         if not self.__conn:
             raise osdbError("connection not available")
 
-        update_str = ""
-        for k, v in update_keys.items():
-            update_str += ", {} = ".format(k)
-            if type(v) == int:
-                update_str += str(v)
-            else:
-                update_str += "'{}'".format(
-                        v.translate(str.maketrans({'\'': '\\\''})))
-        where_str = self.get_where(filter_keys)
-        statement = "UPDATE {} SET {}{}".format(table,
-                update_str[2:], where_str)
+        # lists of update and filter keys are applied in one batch
+        if type(update_keys) == list:
+            updates = update_keys
+            filters = filter_keys or [None] * len(updates)
+        else:
+            updates = [update_keys]
+            filters = [filter_keys]
+        columns = tuple(updates[0].keys())
+        where_columns = tuple(filters[0].keys()) if filters[0] else ()
+        key = ("update", table, columns, where_columns)
+        statement = self.__statements.get(key)
+        if statement is None:
+            # the values are bound with a prefix, as SQLAlchemy reserves the
+            # names of the columns for its own SET parameters
+            statement = sql_table(table, *[column(c) for c in columns]).\
+                    update().values({c: bindparam("v_" + c) for c in columns})
+            where = self.get_where(where_columns)
+            if where is not None:
+                statement = statement.where(where)
+            self.__statements[key] = statement
+        params = self.get_where_params(filters)
+        for row, update in zip(params, updates):
+            row.update({"v_" + k: v for k, v in update.items()})
         try:
-            result = self.__conn.execute(text(statement))
+            result = self.__conn.execute(statement,
+                    params if type(update_keys) == list else params[0])
         except sqlalchemy.exc.SQLAlchemyError as ex:
             logger.error("cannot execute query: {}".format(statement))
             logger.error(ex)
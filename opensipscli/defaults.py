@@ -77,17 +77,33 @@ DEFAULT_VALUES = {
 
     # user module
     "plain_text_passwords": "False",
+    "user_chunk_size": "1000",
 
     # diagnose module
     "diagnose_listen_ip": "127.0.0.1",
     "diagnose_listen_port": "8899",
+    "diagnose_top_size": "3",
+    "diagnose_summary_size": "1000",
+    "diagnose_trend_size": "600",
+    "diagnose_advise_window": "60",
+    "diagnose_target_load": "50",
+    "diagnose_memory_headroom": "50",
 
     # trace module
     "trace_listen_ip": "127.0.0.1",
     "trace_listen_port": "0",
+    "trace_reorder_window": "200",
+    "trace_call_timeout": "30",
+    "trace_max_calls": "10000",
 
     # trap module
-    "trap_file": '/tmp/gdb_opensips_{}'.format(time.strftime('%Y%m%d_%H%M%S'))
+    "trap_file": '/tmp/gdb_opensips_{}'.format(time.strftime('%Y%m%d_%H%M%S')),
+    "trap_jobs": "4",
+    "trap_timeout": "30",
+    "trap_single_gdb": "False",
+    "trap_compress": "False",
+    "trap_sample_interval": "100",
+    "trap_watch_duration": "5",
 }
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -50,6 +50,38 @@ class Module:
          """
          return None
 
+    def __get_value_modifiers__(self):
+         """
+         returns the modifiers of the module that expect a value, so that
+         `--opt value` is not mistaken for a command
+         """
+         return None
+
+    def parse_options(self, tokens, options):
+        """
+        splits the `--opt value` or `--opt=value` options out of tokens;
+        options maps every known option to True if it expects a value
+        returns a dict with the parsed options and the remaining tokens
+        """
+        parsed = {}
+        remaining = []
+        tokens = list(tokens) if tokens else []
+        while tokens:
+            token = tokens.pop(0)
+            name, sep, value = token.partition("=")
+            if name not in options:
+                remaining.append(token)
+                continue
+            if not options[name]:
+                parsed[name] = True
+            elif sep:
+                parsed[name] = value
+            elif tokens:
+                parsed[name] = tokens.pop(0)
+            else:
+                raise ValueError("option '{}' expects a value".format(name))
+        return parsed, remaining
+
     def __complete__(self, command, text, line, begidx, endidx):
         """
         returns a list with all the auto-completion values
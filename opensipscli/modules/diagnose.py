@@ -21,6 +21,7 @@ from opensipscli.module import Module
 from opensipscli.logger import logger
 from opensipscli.config import cfg
 from opensipscli import comm
+from opensipscli.screen import Screen, Keyboard
 from threading import Thread
 import socket
 import subprocess
@@ -30,7 +31,7 @@ import os
 import re
 import time
 import threading
-import bisect
+import heapq
 import random
 
 try:
@@ -39,8 +40,14 @@ try:
 except:
     have_psutil = False
 
+import codecs
+import ipaddress
+import sys
+import math
+import gzip
 import json
 from json.decoder import WHITESPACE
+from collections import deque
 
 DNS_THR_EVENTS = ['dns']
 SQL_THR_EVENTS = ['mysql', 'pgsql']
@@ -48,8 +55,328 @@ NOSQL_THR_EVENTS = ['Cassandra', 'cachedb_local', 'MongoDB',
                     'cachedb_memcached', 'cachedb_couchbase']
 SIP_THR_EVENTS = ['msg processing']
 
-thr_summary = {}
-thr_slowest = []
+THR_RECV_SIZE = 65536
+
+# dashboard panels: name, toggle key, description, statistics needed,
+# threshold events reported and title
+DASHBOARD_PANELS = [
+    ('load', '1', 'load', ['load:'], [], "Worker Capacity"),
+    ('memory', '2', 'memory', ['shmem:', 'pkmem:'], [], "Memory"),
+    ('sip', '3', 'SIP', ['rcv_requests', 'rcv_replies', 'slow_messages'],
+        SIP_THR_EVENTS, "SIP Processing"),
+    ('dns', '4', 'DNS', ['dns_total_queries', 'dns_slow_queries'],
+        DNS_THR_EVENTS, "DNS Queries"),
+    ('sql', '5', 'SQL', ['sql_total_queries', 'sql_slow_queries'],
+        SQL_THR_EVENTS, "SQL Queries"),
+    ('nosql', '6', 'NoSQL', ['cdb_total_queries', 'cdb_slow_queries'],
+        NOSQL_THR_EVENTS, "NoSQL Queries"),
+]
+
+# the kernel socket tables, parsed once per tick
+NET_SOCKET_FILES = [
+    ('udp', '/proc/net/udp'),
+    ('udp', '/proc/net/udp6'),
+    ('tcp', '/proc/net/tcp'),
+    ('tcp', '/proc/net/tcp6'),
+]
+TCP_LISTEN = '0A'
+
+SEVERITIES = ["OK", "NOTICE", "WARNING", "CRITICAL"]
+
+# exit codes of the --json mode, as used by the monitoring plugins
+JSON_EXIT_CODES = {"OK": 0, "NOTICE": 0, "WARNING": 1, "CRITICAL": 2}
+JSON_EXIT_UNKNOWN = 3
+
+DIAGNOSE_OPTIONS = {
+    '--json': False,
+    '--interval': True,
+    '--count': True,
+    '--record': True,
+    '--replay': True,
+    '--speed': True,
+    '--trend': False,
+    '--window': True,
+}
+
+class SpaceSaving(object):
+    """
+    Space-Saving heavy hitters sketch: counts the most frequent keys using a
+    fixed number of counters; when full, a new key takes over the smallest
+    counter, inheriting its count as the over-estimation error
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+        # min-heap of (count, key), with stale entries skipped lazily
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, key):
+        try:
+            counter = self.counters[key]
+            counter[0] += 1
+        except KeyError:
+            if len(self.counters) < self.capacity:
+                counter = [1, 0]
+            else:
+                while True:
+                    count, victim = heapq.heappop(self.heap)
+                    current = self.counters.get(victim)
+                    if current and current[0] == count:
+                        break
+                del self.counters[victim]
+                counter = [count + 1, count]
+            self.counters[key] = counter
+        heapq.heappush(self.heap, (counter[0], key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(c[0], k) for k, c in self.counters.items()]
+            heapq.heapify(self.heap)
+
+    def top(self, n):
+        """
+        returns the n most frequent (count, key) pairs
+        """
+        return heapq.nlargest(n, [(c[0], k) for k, c in
+                list(self.counters.items())])
+
+class TopSlowest(object):
+    """
+    keeps the n slowest events, using a min-heap of size n
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, duration, *info):
+        # seq breaks ties, so the info itself is never compared
+        item = (duration, self.seq, info)
+        self.seq += 1
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, item)
+        elif duration > self.heap[0][0]:
+            heapq.heapreplace(self.heap, item)
+
+    def top(self):
+        """
+        returns the (duration, *info) of the events, slowest first
+        """
+        return [(d,) + info for d, _, info in
+                sorted(list(self.heap), reverse=True)]
+
+thr_summary = SpaceSaving(1)
+thr_slowest = TopSlowest(1)
+
+def reset_thr_stats():
+    global thr_summary, thr_slowest
+
+    thr_summary = SpaceSaving(int(cfg.get("diagnose_summary_size")))
+    thr_slowest = TopSlowest(int(cfg.get("diagnose_top_size")))
+
+class RollingRegression(object):
+    """
+    least squares fit of the (x, y) samples in a sliding window; the sums
+    are updated in constant time per sample, and recomputed once per window
+    so that the rounding errors do not pile up
+    """
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.origin = None
+        self.evicted = 0
+        self.sums = [0.0] * 5
+
+    def __len__(self):
+        return len(self.samples)
+
+    def update(self, x, y, sign):
+        self.sums[0] += sign * x
+        self.sums[1] += sign * y
+        self.sums[2] += sign * x * x
+        self.sums[3] += sign * x * y
+        self.sums[4] += sign * y * y
+
+    def add(self, x, y):
+        # keep the values small, relative to the first sample
+        if self.origin is None:
+            self.origin = (x, y)
+        x -= self.origin[0]
+        y -= self.origin[1]
+
+        if len(self.samples) == self.samples.maxlen:
+            self.update(*self.samples[0], -1)
+            self.evicted += 1
+        self.samples.append((x, y))
+        self.update(x, y, 1)
+
+        if self.evicted >= self.samples.maxlen:
+            self.evicted = 0
+            self.sums = [0.0] * 5
+            for sample in self.samples:
+                self.update(*sample, 1)
+
+    def fit(self):
+        """
+        returns the slope and the correlation coefficient of the samples,
+        or None if there are not enough of them
+        """
+        n = len(self.samples)
+        if n < 2:
+            return None
+        sx, sy, sxx, sxy, syy = self.sums
+        var_x = n * sxx - sx * sx
+        var_y = n * syy - sy * sy
+        cov = n * sxy - sx * sy
+        if var_x <= 0:
+            return None
+        slope = cov / var_x
+        corr = cov / math.sqrt(var_x * var_y) if var_y > 0 else 0.0
+        return slope, corr
+
+    def span(self):
+        """the x interval covered by the samples"""
+        return self.samples[-1][0] - self.samples[0][0] if self.samples else 0
+
+class MemoryTrend(object):
+    """
+    tracks the usage of a memory pool in time, to detect steady growth
+    """
+
+    # the correlation above which the usage is considered to grow steadily
+    STEADY_CORR = 0.9
+    # the minimum number of samples needed to estimate a trend
+    MIN_SAMPLES = 10
+
+    def __init__(self, size):
+        self.regression = RollingRegression(size)
+        self.used = 0
+        self.total = 0
+
+    def add(self, ts, used, total):
+        self.regression.add(ts, used)
+        self.used = used
+        self.total = total
+
+    def growth(self):
+        """
+        returns the steady growth rate (bytes per second) and the estimated
+        seconds until the pool is exhausted, or None if not growing steadily
+        """
+        if len(self.regression) < self.MIN_SAMPLES:
+            return None
+        fit = self.regression.fit()
+        if fit is None or fit[0] <= 0 or fit[1] < self.STEADY_CORR:
+            return None
+        return fit[0], max(self.total - self.used, 0) / fit[0]
+
+class ProcSampler(object):
+    """
+    samples the OS resource usage of processes straight from /proc, and
+    derives their rates between consecutive samples
+    """
+
+    try:
+        CLK_TCK = os.sysconf('SC_CLK_TCK')
+    except (AttributeError, ValueError, OSError):
+        CLK_TCK = 100
+
+    def __init__(self):
+        self.prev = {}
+
+    def read(self, pid):
+        """
+        returns the raw counters of a process, or None if it is not running
+        on this host
+        """
+        raw = {}
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                # the command name may contain spaces, skip past it
+                fields = f.read().rsplit(")", 1)[1].split()
+            raw['start'] = int(fields[19])
+            raw['cpu_ticks'] = int(fields[11]) + int(fields[12])
+
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    if name == "VmRSS":
+                        raw['rss'] = int(value.split()[0]) * 1024
+                    elif name == "voluntary_ctxt_switches":
+                        raw['vol_cs'] = int(value)
+                    elif name == "nonvoluntary_ctxt_switches":
+                        raw['invol_cs'] = int(value)
+        except (OSError, IndexError, ValueError):
+            return None
+
+        # not available on all kernels, or for all users
+        try:
+            with open("/proc/{}/schedstat".format(pid)) as f:
+                run_ns, wait_ns, _ = f.read().split()
+            raw['run_ns'] = int(run_ns)
+            raw['wait_ns'] = int(wait_ns)
+        except (OSError, ValueError):
+            pass
+        try:
+            with open("/proc/{}/io".format(pid)) as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    if name in ("rchar", "wchar"):
+                        raw[name] = int(value)
+        except (OSError, ValueError):
+            pass
+        return raw
+
+    def sample(self, pids):
+        """
+        samples all the pids in one pass; returns, for each of them, the
+        usage since the previous sample: 'cpu' and run-queue 'wait'
+        percentages, voluntary and involuntary context switches and I/O
+        bytes per second, along with the current 'rss'
+        """
+        now = time.monotonic()
+        samples = {}
+        current = {}
+        for pid in pids:
+            raw = self.read(pid)
+            if raw is None:
+                continue
+            raw['ts'] = now
+            current[pid] = raw
+            prev = self.prev.get(pid)
+            # a reused pid is a different process
+            if prev is None or prev['start'] != raw['start'] or \
+                    now <= prev['ts']:
+                continue
+            elapsed = now - prev['ts']
+
+            def rate(name):
+                if name not in raw or name not in prev:
+                    return None
+                return (raw[name] - prev[name]) / elapsed
+
+            sample = {
+                'rss': raw.get('rss'),
+                'vol_cs': rate('vol_cs'),
+                'invol_cs': rate('invol_cs'),
+                'read': rate('rchar'),
+                'write': rate('wchar'),
+                'wait': None,
+                }
+            if 'run_ns' in raw and 'run_ns' in prev:
+                sample['cpu'] = rate('run_ns') / 1e7
+                sample['wait'] = rate('wait_ns') / 1e7
+            else:
+                sample['cpu'] = rate('cpu_ticks') / self.CLK_TCK * 100
+            samples[pid] = sample
+        self.prev = current
+        return samples
 
 """ cheers to Philippe: https://stackoverflow.com/a/325528/2054305 """
 class StoppableThread(threading.Thread):
@@ -64,6 +391,9 @@ class StoppableThread(threading.Thread):
         return self._stop_event.is_set()
 
 class ThresholdCollector(StoppableThread):
+    # the session recording the events, if any
+    session = None
+
     def __init__(self, *args, **kwargs):
         kwargs['target'] = self.collect_events
 
@@ -107,10 +437,7 @@ class ThresholdCollector(StoppableThread):
                 }, silent=True)
 
     def collect_events(self, events=None):
-        global thr_summary, thr_slowest
-
-        thr_summary = {}
-        thr_slowest = []
+        reset_thr_stats()
 
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -136,16 +463,14 @@ class ThresholdCollector(StoppableThread):
                 self.collect_loop(conn, events)
 
     def collect_loop(self, conn, events):
-        global thr_summary, thr_slowest
-
-        string = ""
+        decoder = JSONStreamDecoder()
         while True:
             self.mi_refresh_sub()
 
             try:
-                new = conn.recv(1024).decode('utf-8')
+                new = conn.recv(THR_RECV_SIZE)
             except socket.timeout:
-                new = ""
+                new = b""
 
             if threading.current_thread().stopped():
                 self.mi_unsub()
@@ -154,54 +479,205 @@ class ThresholdCollector(StoppableThread):
             if not new:
                 continue
 
-            string += new
+            for obj in decoder.feed(new):
+                if isinstance(obj, dict) and 'params' in obj:
+                    if self.session:
+                        self.session.event(dict(obj['params']))
+                    self.process_event(obj['params'], events)
 
-            decoder = json.JSONDecoder()
-            idx = WHITESPACE.match(string, 0).end()
-            while idx < len(string):
-                try:
-                    obj, end = decoder.raw_decode(string, idx)
-                except json.decoder.JSONDecodeError:
-                    # partial JSON -- just let it accumulate
-                    break
+    def process_event(self, params, events):
+        # only process threshold events we're interested in
+        if events is not None and \
+                not any(params['source'].startswith(e) for e in events):
+            return
 
-                if 'params' not in obj:
-                    string = string[end:]
+        if 'extra' not in params:
+            params['extra'] = "<unknown>"
+
+        if not self.skip_summ:
+            thr_summary.add((params['extra'], params['source']))
+
+        thr_slowest.add(params['time'], params['extra'], params['source'])
+
+class JSONStreamDecoder(object):
+    """
+    incremental decoder for a stream of concatenated JSON objects: bytes are
+    decoded by an incremental UTF-8 decoder (which holds back sequences split
+    across reads), while the JSON parsing resumes from the last offset and
+    the consumed text is only discarded once it adds up
+    """
+
+    # consumed characters are only discarded once they add up to this much
+    COMPACT_SIZE = 65536
+    # a pending object this large that does not parse is garbage
+    MAX_PENDING = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.decoder = json.JSONDecoder()
+        self.text = ""
+        self.pos = 0
+
+    def feed(self, data):
+        """
+        appends data to the stream and returns the objects completed
+        """
+        self.text += self.utf8.decode(data)
+        text = self.text
+        pos = self.pos
+        objs = []
+        while True:
+            pos = WHITESPACE.match(text, pos).end()
+            if pos >= len(text):
+                break
+            try:
+                obj, pos = self.decoder.raw_decode(text, pos)
+            except json.decoder.JSONDecodeError:
+                # partial JSON -- just let it accumulate, unless it is
+                # obviously broken, in which case skip to the next object
+                if len(text) - pos > self.MAX_PENDING:
+                    logger.warning("dropping invalid JSON data")
+                    nxt = text.find("{", pos + 1)
+                    pos = nxt if nxt > 0 else len(text)
                     continue
-
-                params = obj['params']
-
-                # only process threshold events we're interested in
-                if events is None or \
-                        any(params['source'].startswith(e) for e in events):
-                    if 'extra' not in params:
-                        params['extra'] = "<unknown>"
-
-                    if not self.skip_summ:
-                        try:
-                            thr_summary[(params['extra'],
-                                        params['source'])] += 1
-                        except:
-                            thr_summary[(params['extra'],
-                                        params['source'])] = 1
-
-                    bisect.insort(thr_slowest, (-params['time'],
-                                    params['extra'], params['source']))
-                    thr_slowest = thr_slowest[:3]
-
-                string = string[end:]
-                idx = WHITESPACE.match(string, 0).end()
+                break
+            objs.append(obj)
+
+        if pos == len(text) or pos >= self.COMPACT_SIZE:
+            self.text = text[pos:]
+            pos = 0
+        self.pos = pos
+        return objs
+
+class SessionRecorder(object):
+    """
+    records the MI answers and the threshold events of a diagnose session
+    in a gzip-compressed log, as one JSON object per line
+    """
+
+    def __init__(self, path):
+        self.file = gzip.open(path, "wt")
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+
+    def execute(self, cmd, params=None, silent=False):
+        ans = comm.execute(cmd, params, silent)
+        self.write({'ts': time.time(), 'mi': cmd, 'result': ans})
+        # flush at every MI command, so that a crash loses at most a tick
+        with self.lock:
+            self.file.flush()
+        return ans
+
+    def event(self, params):
+        self.write({'ts': time.time(), 'event': params})
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class SessionPlayer(object):
+    """
+    replays a recorded diagnose session: MI commands are answered from the
+    log, at the recorded pace (scaled by speed), while the threshold events
+    recorded in the meantime are passed to the collector, if any
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.file = gzip.open(path, "rt")
+        self.speed = speed
+        self.collector = None
+        self.events = None
+        self.start = None
+        self.ts = None
+
+    def records(self):
+        for line in self.file:
+            if line.strip():
+                yield json.loads(line)
+
+    def execute(self, cmd, params=None, silent=False):
+        try:
+            for record in self.records():
+                if 'event' in record:
+                    if self.collector:
+                        self.collector.process_event(record['event'],
+                                self.events)
+                    continue
+                self.pace(record['ts'])
+                if record['mi'] == cmd:
+                    return record['result']
+        except (OSError, EOFError, ValueError) as e:
+            logger.error("cannot read the recorded session: {}".format(e))
+            return None
+        if not silent:
+            logger.info("end of the recorded session")
+        return None
+
+    def pace(self, ts):
+        """
+        waits until the recorded ts is reached on the replay clock
+        """
+        if self.start is None:
+            self.start = (ts, time.time())
+        self.ts = ts
+        delay = (ts - self.start[0]) / self.speed - \
+                (time.time() - self.start[1])
+        if delay > 0:
+            time.sleep(delay)
+
+    def now(self):
+        return self.ts if self.ts is not None else time.time()
+
+    def sleep(self, seconds):
+        """the pace of the replay is given by the recorded commands"""
+        pass
+
+    def close(self):
+        self.file.close()
 
 class diagnose(Module):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.t = None
+        self.session = None
+        self.screen = Screen()
         self.__rcv_proto = 'tcp'
         self.__rcv_ip = cfg.get("diagnose_listen_ip")
         self.__rcv_port = int(cfg.get("diagnose_listen_port"))
 
+    @property
+    def use_psutil(self):
+        # the processes of a replayed session are not running here
+        return have_psutil and not isinstance(self.session, SessionPlayer)
+
+    def mi(self, cmd, params=None, silent=False):
+        """
+        runs an MI command, through the recorded session, if any
+        """
+        if self.session:
+            return self.session.execute(cmd, params, silent)
+        return comm.execute(cmd, params, silent)
+
+    def now(self):
+        return self.session.now() if self.session else time.time()
+
+    def sleep(self, seconds):
+        if self.session:
+            self.session.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
     def getOpenSIPSVersion(self):
-        ans = comm.execute('version')
+        ans = self.mi('version')
         if not ans:
             return
 
@@ -209,6 +685,15 @@ class diagnose(Module):
         return ver.groupdict()
 
     def startThresholdCollector(self, events, skip_summ=False):
+        if isinstance(self.session, SessionPlayer):
+            # the recorded events are fed by the player instead
+            reset_thr_stats()
+            self.session.collector = ThresholdCollector(events=events,
+                    skip_summ=skip_summ, rcv_proto=self.__rcv_proto,
+                    rcv_ip=self.__rcv_ip, rcv_port=self.__rcv_port)
+            self.session.events = events
+            return True
+
         version = self.getOpenSIPSVersion()
         if not version:
             logger.error("Can't detect OpenSIPS version")
@@ -223,6 +708,7 @@ class diagnose(Module):
         # subscribe for, then collect "query threshold exceeded" events
         self.t = ThresholdCollector(events=events, skip_summ=skip_summ,
                 rcv_proto=self.__rcv_proto,rcv_ip=self.__rcv_ip,rcv_port=self.__rcv_port,)
+        self.t.session = self.session
         self.t.daemon = True
         self.t.start()
         for i in range(15):
@@ -246,12 +732,19 @@ class diagnose(Module):
         self.stopThresholdCollector()
         return self.startThresholdCollector(events, skip_summ)
 
+    def render(self, loop, *args):
+        """
+        runs an iteration of a diagnose loop, displaying its output as a frame
+        """
+        with self.screen.frame():
+            return loop(*args)
+
     def print_diag_footer(self):
         print("\n{}(press Ctrl-c to exit)".format('\t' * 5))
 
     def diagnose_dns(self):
         # quickly ensure opensips is running
-        ans = comm.execute('get_statistics', {
+        ans = self.mi('get_statistics', {
                 'statistics': ['dns_total_queries', 'dns_slow_queries']
                 })
         if ans is None:
@@ -270,9 +763,9 @@ class diagnose(Module):
         sec = 0
         try:
             while True:
-                if not self.diagnose_dns_loop(sec, stats):
+                if not self.render(self.diagnose_dns_loop, sec, stats):
                     break
-                time.sleep(1)
+                self.sleep(1)
                 sec += 1
         except KeyboardInterrupt:
             print('^C')
@@ -280,23 +773,22 @@ class diagnose(Module):
             self.stopThresholdCollector()
 
     def diagnose_dns_loop(self, sec, stats):
-        global thr_summary, thr_slowest
+        top_size = thr_slowest.n
 
-        os.system("clear")
         print("In the last {} seconds...".format(sec))
         if not thr_summary:
             print("    DNS Queries [OK]".format(sec))
         else:
             print("    DNS Queries [WARNING]".format(sec))
             print("        * Slowest queries:")
-            for q in thr_slowest:
-                print("            {} ({} us)".format(q[1], -q[0]))
+            for q in thr_slowest.top():
+                print("            {} ({} us)".format(q[1], q[0]))
             print("        * Constantly slow queries")
-            for q in sorted([(v, k) for k, v in thr_summary.items()], reverse=True)[:3]:
+            for q in thr_summary.top(top_size):
                 print("            {} ({} times exceeded threshold)".format(
                         q[1][0], q[0]))
 
-        ans = comm.execute('get_statistics', {
+        ans = self.mi('get_statistics', {
                 'statistics': ['dns_total_queries', 'dns_slow_queries']
                 })
         if not ans:
@@ -306,8 +798,7 @@ class diagnose(Module):
         if int(ans['dns:dns_total_queries']) < stats['total']:
             stats['ini_total'] = int(ans['dns:dns_total_queries'])
             stats['ini_slow'] = int(ans['dns:dns_slow_queries'])
-            thr_summary = {}
-            thr_slowest = []
+            reset_thr_stats()
             sec = 1
             if not self.restartThresholdCollector(DNS_THR_EVENTS):
                 return
@@ -331,7 +822,7 @@ class diagnose(Module):
 
     def diagnose_db(self, dbtype, events):
         # quickly ensure opensips is running
-        ans = comm.execute('get_statistics', {
+        ans = self.mi('get_statistics', {
                 'statistics': ['{}_total_queries'.format(dbtype[0]),
                                 '{}_slow_queries'.format(dbtype[0])]
                 })
@@ -351,9 +842,10 @@ class diagnose(Module):
         sec = 0
         try:
             while True:
-                if not self.diagnose_db_loop(sec, stats, dbtype, events):
+                if not self.render(self.diagnose_db_loop,
+                        sec, stats, dbtype, events):
                     break
-                time.sleep(1)
+                self.sleep(1)
                 sec += 1
         except KeyboardInterrupt:
             print('^C')
@@ -361,26 +853,24 @@ class diagnose(Module):
             self.stopThresholdCollector()
 
     def diagnose_db_loop(self, sec, stats, dbtype, events):
-        global thr_summary, thr_slowest
-
+        top_size = thr_slowest.n
         total_stat = '{}_total_queries'.format(dbtype[0])
         slow_stat = '{}_slow_queries'.format(dbtype[0])
 
-        os.system("clear")
         print("In the last {} seconds...".format(sec))
         if not thr_summary:
             print("    {} Queries [OK]".format(dbtype[1]))
         else:
             print("    {} Queries [WARNING]".format(dbtype[1]))
             print("        * Slowest queries:")
-            for q in thr_slowest:
-                print("            {}: {} ({} us)".format(q[2], q[1], -q[0]))
+            for q in thr_slowest.top():
+                print("            {}: {} ({} us)".format(q[2], q[1], q[0]))
             print("        * Constantly slow queries")
-            for q in sorted([(v, k) for k, v in thr_summary.items()], reverse=True)[:3]:
+            for q in thr_summary.top(top_size):
                 print("            {}: {} ({} times exceeded threshold)".format(
                         q[1][1], q[1][0], q[0]))
 
-        ans = comm.execute('get_statistics',
+        ans = self.mi('get_statistics',
                     {'statistics': [total_stat, slow_stat]
             })
         if not ans:
@@ -390,8 +880,7 @@ class diagnose(Module):
         if int(ans["{}:{}".format(dbtype[0], total_stat)]) < stats['total']:
             stats['ini_total'] = int(ans["{}:{}".format(dbtype[0], total_stat)])
             stats['ini_slow'] = int(ans["{}:{}".format(dbtype[0], slow_stat)])
-            thr_summary = {}
-            thr_slowest = []
+            reset_thr_stats()
             sec = 1
             if not self.restartThresholdCollector(events):
                 return
@@ -411,7 +900,7 @@ class diagnose(Module):
 
     def diagnose_sip(self):
         # quickly ensure opensips is running
-        ans = comm.execute('get_statistics', {
+        ans = self.mi('get_statistics', {
                 'statistics': ['rcv_requests', 'rcv_replies', 'slow_messages']
                 })
         if ans is None:
@@ -430,9 +919,9 @@ class diagnose(Module):
         sec = 0
         try:
             while True:
-                if not self.diagnose_sip_loop(sec, stats):
+                if not self.render(self.diagnose_sip_loop, sec, stats):
                     break
-                time.sleep(1)
+                self.sleep(1)
                 sec += 1
         except KeyboardInterrupt:
             print('^C')
@@ -440,19 +929,16 @@ class diagnose(Module):
             self.stopThresholdCollector()
 
     def diagnose_sip_loop(self, sec, stats):
-        global thr_slowest
-
-        os.system("clear")
         print("In the last {} seconds...".format(sec))
         if not thr_slowest:
             print("    SIP Processing [OK]")
         else:
             print("    SIP Processing [WARNING]")
             print("        * Slowest SIP messages:")
-            for q in thr_slowest:
-                print("            {} ({} us)".format(desc_sip_msg(q[1]), -q[0]))
+            for q in thr_slowest.top():
+                print("            {} ({} us)".format(desc_sip_msg(q[1]), q[0]))
 
-        ans = comm.execute('get_statistics', {'statistics':
+        ans = self.mi('get_statistics', {'statistics':
                             ['rcv_requests', 'rcv_replies', 'slow_messages']})
         if not ans:
             return False
@@ -465,7 +951,7 @@ class diagnose(Module):
         if rcv_req + rcv_rpl < stats['total']:
             stats['ini_total'] = rcv_req + rcv_rpl
             stats['ini_slow'] = slow_msgs
-            thr_slowest = []
+            reset_thr_stats()
             sec = 1
             if not self.restartThresholdCollector(SIP_THR_EVENTS, skip_summ=True):
                 return
@@ -481,20 +967,22 @@ class diagnose(Module):
 
         return True
 
-    def diagnose_mem(self):
+    def diagnose_mem(self, opts=None):
+        if opts and '--trend' in opts:
+            return self.diagnose_mem_trend(opts)
+
         try:
             while True:
-                if not self.diagnose_mem_loop():
+                if not self.render(self.diagnose_mem_loop):
                     break
-                time.sleep(1)
+                self.sleep(1)
         except KeyboardInterrupt:
             print('^C')
 
     def diagnose_mem_loop(self):
-        os.system("clear")
-        ans = comm.execute('get_statistics', {
+        ans = self.mi('get_statistics', {
                                 'statistics': ['shmem:', 'pkmem:']})
-        ps = comm.execute('ps')
+        ps = self.mi('ps')
         if ans is None or ps is None:
             return False
 
@@ -508,6 +996,105 @@ class diagnose(Module):
         self.print_diag_footer()
         return True
 
+    def diagnose_mem_trend(self, opts):
+        try:
+            interval = float(opts.get('--interval', 1))
+        except ValueError:
+            logger.error("invalid --interval value")
+            return -1
+
+        trends = {}
+        size = int(cfg.get("diagnose_trend_size"))
+        try:
+            while True:
+                if not self.render(self.diagnose_mem_trend_loop, trends, size):
+                    break
+                self.sleep(interval)
+        except KeyboardInterrupt:
+            print('^C')
+
+    def diagnose_mem_trend_loop(self, trends, size):
+        ans = self.mi('get_statistics', {
+                                'statistics': ['shmem:', 'pkmem:']})
+        ps = self.mi('ps')
+        if ans is None or ps is None or not ps['Processes']:
+            return False
+        ts = self.now()
+
+        # the pools of a restarted OpenSIPS (or process) start a new trend
+        pools = {}
+        try:
+            pools[('shm', ps['Processes'][0]['PID'])] = (None,
+                    int(ans['shmem:real_used_size']),
+                    int(ans['shmem:total_size']))
+        except (KeyError, ValueError):
+            pass
+        for proc in ps['Processes']:
+            try:
+                used = int(ans['pkmem:{}-real_used_size'.format(proc['ID'])])
+                total = used + int(ans['pkmem:{}-free_size'.format(
+                    proc['ID'])])
+            except (KeyError, ValueError):
+                continue
+            if total != 0:
+                pools[(proc['ID'], proc['PID'])] = (proc, used, total)
+
+        for key in list(trends):
+            if key not in pools:
+                del trends[key]
+        for key, (proc, used, total) in pools.items():
+            if key not in trends:
+                trends[key] = MemoryTrend(size)
+            trends[key].add(ts, used, total)
+
+        samples = max(len(t.regression) for t in trends.values()) \
+                if trends else 0
+        span = max(t.regression.span() for t in trends.values()) \
+                if trends else 0
+        print("Memory Trend ({} samples over the last {})".format(samples,
+                human_duration(span)))
+        print("-------------------------------------------------")
+        if samples < MemoryTrend.MIN_SAMPLES:
+            print("    collecting samples, {} more needed...".format(
+                    MemoryTrend.MIN_SAMPLES - samples))
+            self.print_diag_footer()
+            return True
+
+        growing = []
+        for key, trend in trends.items():
+            growth = trend.growth()
+            proc = pools[key][0]
+            if proc is None:
+                if growth is None:
+                    print("Shared Memory: {} / {}, no steady growth [OK]".format(
+                        human_size(trend.used), human_size(trend.total)))
+                else:
+                    print("Shared Memory: {} / {}, growing {}/s, "
+                        "full in {} [{}]".format(human_size(trend.used),
+                        human_size(trend.total), human_size(growth[0]),
+                        human_duration(growth[1]), trend_severity(growth[1])))
+                print()
+            elif growth is not None:
+                growing.append((growth[1], growth[0], proc, trend))
+
+        print("Private Memory, steadily growing processes:")
+        # the closest to exhaustion first
+        for ttx, rate, proc, trend in sorted(growing, key=lambda g: g[0]):
+            print("    Process {:>2}: {} / {}, growing {}/s, full in {} [{}] "
+                "({})".format(proc['ID'], human_size(trend.used),
+                    human_size(trend.total), human_size(rate),
+                    human_duration(ttx), trend_severity(ttx), proc['Type']))
+        if not growing:
+            print("    OK: no steady growth detected.")
+
+        print()
+        print("Info: the memory usage of a pool grows steadily if it correlates")
+        print("      with time (r >= {}) over the samples kept; the time until".
+                format(MemoryTrend.STEADY_CORR))
+        print("      exhaustion assumes that the growth continues at this rate.")
+        self.print_diag_footer()
+        return True
+
     def diagnose_shm_stats(self, stats):
         shm_total = int(stats['shmem:total_size'])
         shm_used = int(stats['shmem:real_used_size'])
@@ -622,24 +1209,24 @@ class diagnose(Module):
         pgroups = self.get_opensips_pgroups()
         if pgroups is None:
             return False
-        ppgroups = [pgroups]
+        state = {'pgroups': pgroups, 'sockets': {}, 'snmp': {},
+                'sampler': ProcSampler()}
 
         try:
             while True:
-                if not self.diagnose_load_loop(ppgroups, transports):
+                if not self.render(self.diagnose_load_loop, state, transports):
                     break
-                time.sleep(1)
+                self.sleep(1)
         except KeyboardInterrupt:
             print('^C')
 
-    def diagnose_load_loop(self, ppgroups, transports):
-        pgroups = ppgroups[0]
-        os.system("clear")
+    def diagnose_load_loop(self, state, transports):
+        pgroups = state['pgroups']
 
         print("{}OpenSIPS Processing Status".format(25 * " "))
         print()
 
-        load = comm.execute('get_statistics', {
+        load = self.mi('get_statistics', {
                                 'statistics': ['load:', 'timestamp']})
         if not load:
             return False
@@ -648,40 +1235,85 @@ class diagnose(Module):
         if 'ts' in pgroups and int(load['core:timestamp']) < pgroups['ts']:
             pgroups = self.get_opensips_pgroups()
             pgroups['ts'] = int(load['core:timestamp'])
-            ppgroups[0] = pgroups
+            state['pgroups'] = pgroups
         else:
             pgroups['ts'] = int(load['core:timestamp'])
 
-        # fetch the network waiting queues
+        # fetch the network queues and drops, once for all the interfaces;
+        # the local ones have nothing to do with a replayed session
+        local = not isinstance(self.session, SessionPlayer)
+        sockets = read_net_sockets() if local else {}
+        snmp = read_net_snmp() if local else {}
+        net = {
+            'sockets': sockets,
+            'prev_sockets': state['sockets'],
+            'snmp': {k: v - state['snmp'][k] for k, v in snmp.items()
+                if k in state['snmp']},
+            }
+        state['sockets'] = sockets
+        state['snmp'] = snmp
+
+        # sample the OS usage of all the workers in one pass
+        if not local:
+            procstats = {}
+        else:
+            procstats = state['sampler'].sample([proc['PID']
+                for groups in pgroups.values() if isinstance(groups, dict)
+                    for procs in groups.values() for proc in procs])
+
+        if ('udp' in transports and pgroups['udp']) or \
+                ('hep' in transports and pgroups['hep']):
+            self.diagnose_udp_errors(net['snmp'])
+
         if 'udp' in transports and pgroups['udp']:
-            with open('/proc/net/udp') as f:
-                udp_wait = [line.split() for line in f.readlines()[1:]]
-            self.diagnose_transport_load('udp', pgroups, load, udp_wait)
+            self.diagnose_transport_load('udp', pgroups, load, net,
+                    procstats)
 
         if 'tcp' in transports and pgroups['tcp']:
-            self.diagnose_transport_load('tcp', pgroups, load, None)
+            self.diagnose_transport_load('tcp', pgroups, load, net,
+                    procstats)
 
         if 'hep' in transports and pgroups['hep']:
-            with open('/proc/net/udp') as f:
-                udp_wait = [line.split() for line in f.readlines()[1:]]
-            self.diagnose_transport_load('hep', pgroups, load, udp_wait)
+            self.diagnose_transport_load('hep', pgroups, load, net,
+                    procstats)
 
         print()
         print("Info: the load percentages represent the amount of time spent by an")
         print("      OpenSIPS worker processing SIP messages, as opposed to waiting")
         print("      for new ones.  The three numbers represent the 'busy' percentage")
         print("      over the last 1 sec, last 1 min and last 10 min, respectively.")
+        if procstats:
+            print("      The OS usage of each worker is read from /proc: the run-queue")
+            print("      wait is the time spent waiting for a CPU, while the voluntary")
+            print("      context switches count the times it blocked (e.g. on I/O).")
         self.print_diag_footer()
 
         return True
 
-    def diagnose_transport_load(self, transport, pgroups, load, net_wait):
+    def diagnose_udp_errors(self, deltas):
+        """
+        prints the system-wide UDP receive errors of the last second
+        """
+        if not deltas:
+            return
+        errors = [(name, deltas.get("Udp" + name, 0) +
+                    deltas.get("Udp6" + name, 0))
+                for name in ["RcvbufErrors", "InErrors"]]
+        print("Kernel UDP Errors (all sockets, last 1 sec): {}".format(
+            ", ".join("{} +{}".format(name, count) for name, count in errors)))
+        if any(count for _, count in errors):
+            print("    WARNING: the kernel is dropping UDP packets, "
+                    "the receive buffers are full!")
+        print()
+
+    def diagnose_transport_load(self, transport, pgroups, load, net, procstats):
         for i, (iface, procs) in enumerate(pgroups[transport].items()):
             # TODO: add SCTP support
             if iface != 'TCP' and not iface.startswith('{}'.format(transport)):
                 continue
 
             recvq = None
+            drops = None
 
             if iface == 'TCP':
                 print("TCP Processing")
@@ -692,22 +1324,24 @@ class diagnose(Module):
                 if iface.startswith("hep_"):
                     iface = iface[4:]
 
-                try:
-                    # 127.0.0.1:5060 -> 0100007F, 13C4
-                    ip = "{:02X}{:02X}{:02X}{:02X}".format(*reversed(list(
-                                map(int, iface[4:].split(':')[0].split('.')))))
-                    port = hex(int(iface[4:].split(':')[1]))[2:].upper()
-                    for line in net_wait:
-                        if line[1] == "{}:{}".format(ip, port):
-                            recvq = int("0x" + line[4].split(':')[1], 0)
-                            break
-                except:
-                    pass
+                key = parse_iface(iface)
+                sock = net['sockets'].get(key)
+                if sock is not None:
+                    recvq = sock['rx_queue']
+                    prev = net['prev_sockets'].get(key)
+                    if prev is not None and sock['drops'] is not None:
+                        drops = sock['drops'] - prev['drops']
 
-                print("    Receive Queue: {}".format(
-                        "???" if recvq is None else human_size(recvq)))
+                print("    Receive Queue: {}, Drops: {}".format(
+                        "???" if recvq is None else human_size(recvq),
+                        "???" if sock is None or sock['drops'] is None else \
+                            "{}{}".format(sock['drops'], "" if drops is None \
+                                else " (+{} last 1 sec)".format(drops))))
 
             tot_cpu = 0.0
+            tot_wait = 0.0
+            tot_vol_cs = 0.0
+            sampled = 0
             tot_l1 = 0
             tot_l2 = 0
             tot_l3 = 0
@@ -735,7 +1369,26 @@ class diagnose(Module):
                     "    Process {:>2} load: {:>2}%, {:>2}%, {:>2}% ({})".format(
                     proc['ID'], l1, l2, l3, proc['Type']))
 
-                if have_psutil:
+                sample = procstats.get(proc['PID'])
+                if sample is not None:
+                    sampled += 1
+                    tot_cpu += sample['cpu']
+                    tot_wait += sample['wait'] or 0
+                    tot_vol_cs += sample['vol_cs'] or 0
+                    proc_lines.append("{}cpu {:>2}%, run-queue wait {}, "
+                        "ctx switches/sec {} vol. {} invol., RSS {}, I/O {}".format(
+                        " " * 15, round(sample['cpu']),
+                        "??" if sample['wait'] is None else \
+                            "{:>2}%".format(round(sample['wait'])),
+                        "??" if sample['vol_cs'] is None else \
+                            round(sample['vol_cs']),
+                        "??" if sample['invol_cs'] is None else \
+                            round(sample['invol_cs']),
+                        human_size(sample['rss'] or 0),
+                        "-" if sample['read'] is None or \
+                            sample['write'] is None else "{}/s".format(
+                            human_size(sample['read'] + sample['write']))))
+                elif self.use_psutil:
                     try:
                         tot_cpu += proc['cpumon'].cpu_percent(interval=None)
                     except psutil.NoSuchProcess:
@@ -743,6 +1396,10 @@ class diagnose(Module):
 
             avg_cpu = round(tot_cpu / len(procs))
             print("    Avg. CPU usage: {}% (last 1 sec)".format(avg_cpu))
+            if sampled:
+                avg_wait = round(tot_wait / sampled)
+                print("    Avg. run-queue wait: {}%, voluntary ctx switches: {}/sec".
+                        format(avg_wait, round(tot_vol_cs / sampled)))
             print()
 
             for proc_line in proc_lines:
@@ -751,6 +1408,9 @@ class diagnose(Module):
 
             if recvq:
                 print("    WARNING: the receive queue is NOT empty, SIP signaling may be slower!")
+            if drops:
+                print("    CRITICAL: the kernel dropped {} packets in the last second!".
+                        format(drops))
 
             tot_l1 = round(tot_l1 / len(procs))
             tot_l2 = round(tot_l2 / len(procs))
@@ -774,19 +1434,24 @@ class diagnose(Module):
                 print("    {}: {}% avg. used worker capacity over the last 10 minutes!".format(
                             severity, tot_l3))
             else:
-                if not recvq:
+                if not recvq and not drops:
                     print("    OK: no issues detected.")
                 print("-" * 70)
                 continue
 
-            if not have_psutil:
+            if not sampled and not self.use_psutil:
                 print("""\n    Suggestion: see the DNS/SQL/NoSQL diagnosis for any slow query
                 reports, otherwise increase 'use_workers' or '{}_workers'!""".format(
                     "tcp" if transport == "tcp" else "udp"))
                 print("-" * 70)
                 continue
 
-            if avg_cpu > 25:
+            if sampled and avg_wait > 10:
+                print("    {}: the workers wait for a CPU {}% of the time!".format(
+                        severity, avg_wait))
+                print("""\n    Suggestion: the server is CPU bound, adding workers will not
+                help -- add CPU cores or more servers!""")
+            elif avg_cpu > 25:
                 if avg_cpu > 50:
                     severity = "CRITICAL"
                 else:
@@ -804,17 +1469,19 @@ class diagnose(Module):
             print("-" * 70)
 
     def get_opensips_pgroups(self):
-        ps = comm.execute('ps')
+        ps = self.mi('ps')
         if ps is None:
             return None
+        return self.group_processes(ps)
 
+    def group_processes(self, ps):
         pgroups = {
             'udp': {},
             'tcp': {},
             'hep': {},
             }
         for proc in ps['Processes']:
-            if have_psutil:
+            if self.use_psutil:
                 proc['cpumon'] = psutil.Process(proc['PID'])
                 proc['cpumon'].cpu_percent(interval=None) # begin cycle count
 
@@ -843,14 +1510,14 @@ class diagnose(Module):
     def diagnosis_summary(self):
         try:
             while True:
-                if not self.diagnosis_summary_loop():
+                if not self.render(self.diagnosis_summary_loop):
                     break
-                time.sleep(1)
+                self.sleep(1)
         except KeyboardInterrupt:
             print('^C')
 
     def diagnosis_summary_loop(self):
-        stats = comm.execute('get_statistics', {
+        stats = self.mi('get_statistics', {
             'statistics': [
                 'load', 'load1m', 'load10m', 'total_size', 'real_used_size',
                 'max_used_size',  'rcv_requests', 'rcv_replies', 'processes_number',
@@ -859,7 +1526,6 @@ class diagnose(Module):
         if not stats:
             return False
 
-        os.system("clear")
         print("{}OpenSIPS Overview".format(" " * 25))
         print("{}-----------------".format(" " * 25))
 
@@ -1021,7 +1687,626 @@ class diagnose(Module):
         self.print_diag_footer()
         return True
 
+    def fetch_snapshot(self, statistics):
+        """
+        fetches the given statistics and the process list in parallel, in
+        a single snapshot shared by all the dashboard panels
+        """
+        snapshot = {}
+
+        def fetch_ps():
+            snapshot['ps'] = self.mi('ps')
+
+        if self.session:
+            # keep the recorded commands in a deterministic order
+            fetch_ps()
+            snapshot['stats'] = self.mi('get_statistics',
+                    {'statistics': statistics})
+        else:
+            thread = Thread(target=fetch_ps)
+            thread.start()
+            snapshot['stats'] = self.mi('get_statistics',
+                    {'statistics': statistics})
+            thread.join()
+        if snapshot['stats'] is None or snapshot['ps'] is None:
+            return None
+        snapshot['ts'] = self.now()
+        return snapshot
+
+    def analyze(self, snapshot, panels, state):
+        """
+        runs the analysis of the given panels over a snapshot
+        """
+        pids = [p['PID'] for p in snapshot['ps']['Processes']]
+        if pids != state.get('pids'):
+            # (re)build the groups only when processes change, so that the
+            # CPU usage is measured between consecutive snapshots
+            state['pids'] = pids
+            state['pgroups'] = self.group_processes(snapshot['ps'])
+            state['base'] = {}
+
+        analysis = {}
+        for panel in DASHBOARD_PANELS:
+            if panel[0] in panels:
+                analysis[panel[0]] = getattr(self,
+                        "analyze_" + panel[0])(snapshot, state)
+        return analysis
+
+    def analyze_load(self, snapshot, state):
+        stats = snapshot['stats']
+        top_size = int(cfg.get("diagnose_top_size"))
+        analysis = {'severity': "OK", 'interfaces': []}
+        for transport, groups in state['pgroups'].items():
+            for iface, procs in groups.items():
+                loads = []
+                for period in ['load', 'load1m', 'load10m']:
+                    vals = [int(stats[k]) for k in
+                            ["load:{}-proc-{}".format(period, p['ID'])
+                                for p in procs] if k in stats]
+                    loads.append(round(sum(vals) / len(vals)) if vals else 0)
+                cpu = None
+                if self.use_psutil:
+                    try:
+                        cpu = round(sum(p['cpumon'].cpu_percent(interval=None)
+                            for p in procs) / len(procs))
+                    except psutil.NoSuchProcess:
+                        pass
+                busiest = sorted(((int(stats.get(
+                        "load:load-proc-{}".format(p['ID']), 0)), p)
+                        for p in procs), key=lambda l: l[0], reverse=True)
+                severity = load_severity(max(loads))
+                analysis['interfaces'].append({
+                    'transport': transport,
+                    'interface': iface,
+                    'processes': len(procs),
+                    'load': loads,
+                    'cpu': cpu,
+                    'severity': severity,
+                    'busiest': [{'id': p['ID'], 'pid': p['PID'], 'load': l}
+                        for l, p in busiest[:top_size]],
+                    })
+                analysis['severity'] = worst_severity(analysis['severity'],
+                        severity)
+        return analysis
+
+    def analyze_memory(self, snapshot, state):
+        stats = snapshot['stats']
+        analysis = {'severity': "OK", 'shared': None, 'private': []}
+        try:
+            total = int(stats['shmem:total_size'])
+            used = int(stats['shmem:real_used_size'])
+            max_used = int(stats['shmem:max_used_size'])
+            perc = round(used / total * 100)
+            max_perc = round(max_used / total * 100)
+            analysis['shared'] = {
+                'used': used,
+                'max_used': max_used,
+                'total': total,
+                'usage': perc,
+                'peak_usage': max_perc,
+                'severity': mem_severity(perc, max_perc),
+                }
+            analysis['severity'] = analysis['shared']['severity']
+        except (KeyError, ValueError, ZeroDivisionError):
+            pass
+
+        private = []
+        for proc in snapshot['ps']['Processes']:
+            try:
+                used = int(stats['pkmem:{}-real_used_size'.format(proc['ID'])])
+                total = used + int(stats['pkmem:{}-free_size'.format(
+                    proc['ID'])])
+                max_used = int(stats['pkmem:{}-max_used_size'.format(
+                    proc['ID'])])
+                perc = round(used / total * 100)
+                max_perc = round(max_used / total * 100)
+            except (KeyError, ValueError, ZeroDivisionError):
+                continue
+            private.append({
+                'id': proc['ID'],
+                'pid': proc['PID'],
+                'type': proc['Type'],
+                'used': used,
+                'max_used': max_used,
+                'total': total,
+                'usage': perc,
+                'peak_usage': max_perc,
+                'severity': mem_severity(perc, max_perc),
+                })
+            analysis['severity'] = worst_severity(analysis['severity'],
+                    private[-1]['severity'])
+        private.sort(key=lambda p: (p['usage'], p['peak_usage']), reverse=True)
+        analysis['private'] = private[:int(cfg.get("diagnose_top_size"))]
+        return analysis
+
+    def analyze_slow(self, snapshot, state, name, total_stats, slow_stat):
+        """
+        analyzes the slow operations since the first snapshot, or since
+        OpenSIPS started, if this is the first one
+        """
+        stats = snapshot['stats']
+        try:
+            total = sum(int(stats[s]) for s in total_stats)
+            slow = int(stats[slow_stat])
+        except (KeyError, ValueError):
+            return None
+        base = state['base'].get(name)
+        # the first snapshot, or OpenSIPS was restarted
+        if base is None or total < base['last_total'] or \
+                slow < base['last_slow']:
+            base = {'total': total, 'slow': slow, 'ts': snapshot['ts'],
+                    'last_total': total, 'last_slow': slow}
+            state['base'][name] = base
+        seconds = int(snapshot['ts'] - base['ts'])
+        analysis = {
+            'seconds': seconds,
+            'delta_total': total - base['last_total'],
+            'delta_slow': slow - base['last_slow'],
+            }
+        base['last_total'] = total
+        base['last_slow'] = slow
+        analysis['since_startup'] = snapshot['ts'] == base['ts']
+        if not analysis['since_startup']:
+            total -= base['total']
+            slow -= base['slow']
+        perc = round(slow / total * 100) if total > 0 else 0
+        analysis['total'] = total
+        analysis['slow'] = slow
+        analysis['percentage'] = perc
+        analysis['severity'] = slow_severity(perc)
+        return analysis
+
+    def analyze_sip(self, snapshot, state):
+        return self.analyze_slow(snapshot, state, 'sip',
+                ['core:rcv_requests', 'core:rcv_replies'],
+                'core:slow_messages')
+
+    def analyze_dns(self, snapshot, state):
+        return self.analyze_slow(snapshot, state, 'dns',
+                ['dns:dns_total_queries'], 'dns:dns_slow_queries')
+
+    def analyze_sql(self, snapshot, state):
+        return self.analyze_slow(snapshot, state, 'sql',
+                ['sql:sql_total_queries'], 'sql:sql_slow_queries')
+
+    def analyze_nosql(self, snapshot, state):
+        return self.analyze_slow(snapshot, state, 'nosql',
+                ['cdb:cdb_total_queries'], 'cdb:cdb_slow_queries')
+
+    def diagnose_advise(self, opts):
+        try:
+            window = int(opts.get('--window', cfg.get("diagnose_advise_window")))
+            target = int(cfg.get("diagnose_target_load"))
+            headroom = int(cfg.get("diagnose_memory_headroom"))
+        except ValueError:
+            logger.error("invalid advise window, target load or headroom")
+            return -1
+
+        data = self.advise_collect(window)
+        if data is None:
+            return -1
+        self.advise_report(data, target, headroom)
+        return True
+
+    def advise_collect(self, window):
+        """
+        samples the load, CPU usage, socket drops, slow messages and memory
+        over window seconds, then returns the aggregated observations
+        """
+        ps = self.mi('ps')
+        if ps is None:
+            return None
+        pgroups = self.group_processes(ps)
+        groups = {}
+        for transport, ifaces in pgroups.items():
+            for iface, procs in ifaces.items():
+                groups[(transport, iface)] = {
+                    'procs': procs,
+                    'socket': None if iface == 'TCP' else parse_iface(
+                        iface[4:] if iface.startswith("hep_") else iface),
+                    'loads': [],
+                    'load10m': 0,
+                    'cpu': [],
+                    'wait': [],
+                    }
+
+        sampler = ProcSampler()
+        local = not isinstance(self.session, SessionPlayer)
+        data = {'ps': ps, 'groups': groups, 'samples': 0, 'window': window,
+                'first': None, 'last': None}
+        try:
+            for sec in range(window + 1):
+                stats = self.mi('get_statistics', {'statistics': ['load:',
+                    'shmem:', 'pkmem:', 'rcv_requests', 'rcv_replies',
+                    'slow_messages']})
+                if stats is None:
+                    return None
+                tick = {
+                    'stats': stats,
+                    'sockets': read_net_sockets() if local else {},
+                    'snmp': read_net_snmp() if local else {},
+                    'cpu': read_host_cpu() if local else None,
+                    }
+                data['first'] = data['first'] or tick
+                data['last'] = tick
+                procstats = sampler.sample([p['PID']
+                    for g in groups.values() for p in g['procs']]) \
+                        if local else {}
+
+                if sec:
+                    data['samples'] += 1
+                    for group in groups.values():
+                        self.advise_sample(group, stats, procstats)
+                    self.render(self.advise_progress, sec, window)
+                    if sec == window:
+                        break
+                self.sleep(1)
+        except KeyboardInterrupt:
+            print('^C')
+            if not data['samples']:
+                return None
+        return data
+
+    def advise_progress(self, sec, window):
+        print("Sampling OpenSIPS for {} seconds, {} more to go...".format(
+            window, window - sec))
+        self.print_diag_footer()
+        return True
+
+    def advise_sample(self, group, stats, procstats):
+        loads = [int(stats["load:load-proc-{}".format(p['ID'])])
+                for p in group['procs']
+                    if "load:load-proc-{}".format(p['ID']) in stats]
+        if loads:
+            group['loads'].append(sum(loads) / len(loads))
+        loads = [int(stats["load:load10m-proc-{}".format(p['ID'])])
+                for p in group['procs']
+                    if "load:load10m-proc-{}".format(p['ID']) in stats]
+        if loads:
+            group['load10m'] = sum(loads) / len(loads)
+        for proc in group['procs']:
+            sample = procstats.get(proc['PID'])
+            if sample is None:
+                continue
+            group['cpu'].append(sample['cpu'])
+            if sample['wait'] is not None:
+                group['wait'].append(sample['wait'])
+
+    def advise_report(self, data, target, headroom):
+        first = data['first']
+        last = data['last']
+        stats = last['stats']
+
+        print("Capacity Advice (based on {} samples over {} seconds)".format(
+            data['samples'], data['window']))
+        print("-" * 60)
+        print("Inputs:")
+        print("    Target worker load: {}%, memory headroom: {}%".format(
+            target, headroom))
+
+        cores = os.cpu_count() or 1
+        host_cpu = None
+        if first['cpu'] and last['cpu'] and last['cpu'][1] > first['cpu'][1]:
+            host_cpu = round((last['cpu'][0] - first['cpu'][0]) /
+                    (last['cpu'][1] - first['cpu'][1]) * 100)
+            print("    Host: {} CPU cores, {}% busy".format(cores, host_cpu))
+
+        try:
+            total = sum(int(stats[s]) - int(first['stats'][s])
+                    for s in ['core:rcv_requests', 'core:rcv_replies'])
+            slow = int(stats['core:slow_messages']) - \
+                    int(first['stats']['core:slow_messages'])
+            slow_perc = round(slow / total * 100) if total > 0 else 0
+            print("    SIP messages: {} received, {} ({}%) slow".format(
+                total, slow, slow_perc))
+        except (KeyError, ValueError):
+            slow_perc = 0
+
+        errors = None
+        if first['snmp'] and last['snmp']:
+            errors = sum(last['snmp'].get(k, 0) - first['snmp'].get(k, 0)
+                    for k in ['UdpRcvbufErrors', 'Udp6RcvbufErrors'])
+            print("    Kernel UDP receive buffer errors: {}".format(errors))
+
+        advice = []
+        workers_advice = []
+        # CPU cores busy with the workers; for the same traffic, this does
+        # not change with the number of workers sharing it
+        cores_busy = 0.0
+        cpu_bound = False
+        for (transport, iface), group in data['groups'].items():
+            if not group['loads']:
+                continue
+            loads = sorted(group['loads'])
+            p95 = loads[min(len(loads) - 1, int(len(loads) * 0.95))]
+            observed = max(p95, group['load10m'])
+            workers = len(group['procs'])
+            line = "    {}: {} workers, load avg. {}%, p95 {}%, " \
+                    "10 min {}%".format(iface, workers,
+                        round(sum(loads) / len(loads)), round(p95),
+                        round(group['load10m']))
+            cpu = sum(group['cpu']) / len(group['cpu']) if group['cpu'] else 0
+            if group['cpu']:
+                line += ", CPU {}%".format(round(cpu))
+            if group['wait']:
+                wait = sum(group['wait']) / len(group['wait'])
+                cpu_bound = cpu_bound or wait > 10
+                line += ", run-queue wait {}%".format(round(wait))
+            sock = group['socket'] and last['sockets'].get(
+                    ('udp',) + group['socket'][1:])
+            prev = group['socket'] and first['sockets'].get(
+                    ('udp',) + group['socket'][1:])
+            if sock and prev and sock['drops'] is not None:
+                line += ", {} drops".format(sock['drops'] - prev['drops'])
+            print(line)
+
+            needed = max(1, math.ceil(workers * observed / target))
+            cores_busy += cpu * workers / 100
+            if iface == 'TCP':
+                setting = "tcp_workers = {}".format(needed)
+            else:
+                setting = "use_workers {} on socket {}".format(needed, iface)
+            # traffic peaks may be longer than the window: never advise less
+            if needed > workers:
+                workers_advice.append("Increase the {} workers from {} to {} "
+                    "({}), to keep their load around {}%".format(
+                        iface, workers, needed, setting, target))
+
+        try:
+            shm = (int(stats['shmem:total_size']),
+                    int(stats['shmem:max_used_size']))
+        except (KeyError, ValueError):
+            shm = None
+        if shm:
+            print("    Shared memory: {} peak usage out of {}".format(
+                human_size(shm[1]), human_size(shm[0])))
+            size = advise_pool_size(shm[0], shm[1], headroom)
+            if size is not None:
+                advice.append("Set the shared memory to {} MB (-m {}), "
+                        "{}% over its peak usage".format(size, size,
+                            headroom))
+
+        pkg = None
+        for proc in data['ps']['Processes']:
+            try:
+                total = int(stats["pkmem:{}-real_used_size".format(
+                    proc['ID'])]) + int(stats["pkmem:{}-free_size".format(
+                        proc['ID'])])
+                peak = int(stats["pkmem:{}-max_used_size".format(proc['ID'])])
+            except (KeyError, ValueError):
+                continue
+            if total and (pkg is None or peak > pkg[1]):
+                pkg = (total, peak)
+        if pkg:
+            print("    Private memory: {} highest peak usage out of {}".format(
+                human_size(pkg[1]), human_size(pkg[0])))
+            size = advise_pool_size(pkg[0], pkg[1], headroom)
+            if size is not None:
+                advice.append("Set the private memory to {} MB (-M {}), "
+                        "{}% over the highest peak usage".format(size, size,
+                            headroom))
+
+        print()
+        print("Recommendations:")
+        if slow_perc > 5:
+            advice.insert(0, "{}% of the SIP messages are slow: check the "
+                "DNS/SQL/NoSQL diagnosis first, as blocking I/O inflates "
+                "the worker load".format(slow_perc))
+        if cpu_bound or (host_cpu is not None and host_cpu > 80):
+            advice.append("Scale out: the workers already wait for a CPU, "
+                "adding more of them will not help")
+        elif advise_scale_out(cores_busy, cores, target):
+            advice.append("Scale out: the workers already keep {:.1f} of the "
+                "{} CPU cores busy, over the {}% target".format(cores_busy,
+                    cores, target))
+        else:
+            advice += workers_advice
+        if errors:
+            advice.append("Increase the socket receive buffers (net.core."
+                "rmem_max), {} packets were dropped".format(errors))
+        if not advice:
+            print("    OK: the current sizing fits the observed traffic.")
+        for line in advice:
+            print("    * {}".format(line))
+
+    def diagnose_dashboard(self):
+        enabled = [p[0] for p in DASHBOARD_PANELS]
+        state = {}
+        try:
+            with Keyboard() as keyboard:
+                while True:
+                    if not enabled:
+                        logger.error("all the dashboard panels are disabled; "
+                                "toggle at least one of: {}".format(", ".join(
+                                "[{}] {}".format(p[1], p[2])
+                                for p in DASHBOARD_PANELS)))
+                        return -1
+                    statistics = []
+                    for panel in DASHBOARD_PANELS:
+                        if panel[0] in enabled:
+                            statistics += panel[3]
+                    snapshot = self.fetch_snapshot(statistics)
+                    if snapshot is None:
+                        break
+                    analysis = self.analyze(snapshot, enabled, state)
+                    self.render(self.diagnose_dashboard_loop, analysis,
+                            enabled)
+
+                    # a replayed session is paced by the player
+                    key = keyboard.read(0 if isinstance(self.session,
+                        SessionPlayer) else 1)
+                    if key == 'q':
+                        break
+                    for panel in DASHBOARD_PANELS:
+                        if panel[1] != key:
+                            continue
+                        if panel[0] in enabled:
+                            enabled.remove(panel[0])
+                        else:
+                            enabled.append(panel[0])
+        except KeyboardInterrupt:
+            print('^C')
+
+    def diagnose_dashboard_loop(self, analysis, enabled):
+        print("{}OpenSIPS Dashboard".format(" " * 25))
+        print("{}------------------".format(" " * 25))
+        for panel in DASHBOARD_PANELS:
+            if panel[0] not in enabled:
+                continue
+            print()
+            if panel[0] in ('load', 'memory'):
+                getattr(self, "dashboard_" + panel[0])(analysis[panel[0]])
+            else:
+                self.dashboard_slow(panel[5], analysis[panel[0]])
+
+        print()
+        print("Toggle: {}   Quit: q".format(" ".join(
+            "[{}] {}{}".format(p[1], p[2], "*" if p[0] in enabled else "")
+                for p in DASHBOARD_PANELS)))
+        return True
+
+    def dashboard_load(self, analysis):
+        print("Worker Capacity (load over 1 sec, 1 min, 10 min)")
+        for iface in analysis['interfaces']:
+            print("    {:<32} {:>3} procs: {:>3}% {:>3}% {:>3}%{} [{}]".format(
+                iface['interface'][:32], iface['processes'], *iface['load'],
+                "" if iface['cpu'] is None else ", CPU {}%".format(
+                    iface['cpu']), iface['severity']))
+
+    def dashboard_memory(self, analysis):
+        print("Memory")
+        shm = analysis['shared']
+        if shm is None:
+            print("    Shared: no statistics found")
+        else:
+            print("    Shared: {} / {} ({}%), peak {}% [{}]".format(
+                human_size(shm['used']), human_size(shm['total']),
+                shm['usage'], shm['peak_usage'], shm['severity']))
+
+        if not analysis['private']:
+            print("    Private: no statistics found")
+        else:
+            pkg = analysis['private'][0]
+            print("    Private: highest usage {}%, peak {}%, in process {} "
+                "({}) [{}]".format(pkg['usage'], pkg['peak_usage'], pkg['id'],
+                    pkg['type'], pkg['severity']))
+
+    def dashboard_slow(self, name, analysis):
+        if analysis is None:
+            print("{:<16} no statistics found".format(name + ":"))
+            return
+        if analysis['since_startup']:
+            since = "since startup"
+        else:
+            since = "in the last {} seconds".format(analysis['seconds'])
+        print("{:<16} {} / {} ({}%) slow {} [{}]".format(name + ":",
+            analysis['slow'], analysis['total'], analysis['percentage'],
+            since, analysis['severity']))
+
+    def diagnose_json(self, cmd, opts):
+        """
+        prints the analysis of each tick as a JSON object, one per line;
+        returns the exit code of the worst severity found
+        """
+        try:
+            interval = float(opts.get('--interval', 1))
+            count = int(opts.get('--count', 0))
+        except ValueError:
+            logger.error("invalid --interval or --count value")
+            return -1
+
+        if cmd in [p[0] for p in DASHBOARD_PANELS]:
+            panels = [cmd]
+        else:
+            panels = [p[0] for p in DASHBOARD_PANELS]
+
+        statistics = []
+        events = []
+        for panel in DASHBOARD_PANELS:
+            if panel[0] in panels:
+                statistics += panel[3]
+                events += panel[4]
+        # slow events are only collected for the views reporting them
+        collecting = events and self.startThresholdCollector(events,
+                skip_summ=(events == SIP_THR_EVENTS))
+
+        state = {}
+        worst = "OK"
+        tick = 0
+        try:
+            while not count or tick < count:
+                if tick:
+                    self.sleep(interval)
+                snapshot = self.fetch_snapshot(statistics)
+                if snapshot is None:
+                    if isinstance(self.session, SessionPlayer):
+                        break
+                    return JSON_EXIT_UNKNOWN
+                analysis = self.analyze(snapshot, panels, state)
+
+                severity = "OK"
+                for panel in analysis.values():
+                    if panel is not None:
+                        severity = worst_severity(severity, panel['severity'])
+                worst = worst_severity(worst, severity)
+
+                tick += 1
+                obj = {
+                    'timestamp': snapshot['ts'],
+                    'tick': tick,
+                    'severity': severity,
+                    'panels': analysis,
+                    }
+                if collecting:
+                    obj['slowest'] = [
+                        {'source': s, 'info': e, 'time': t}
+                            for t, e, s in thr_slowest.top()]
+                    obj['constantly_slow'] = [
+                        {'source': k[1], 'info': k[0], 'count': c}
+                            for c, k in thr_summary.top(thr_slowest.n)]
+                print(json.dumps(obj), flush=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopThresholdCollector()
+
+        return JSON_EXIT_CODES[worst]
+
     def __invoke__(self, cmd, params=None, modifiers=None):
+        try:
+            opts, params = self.parse_options(
+                    (modifiers or []) + (params or []), DIAGNOSE_OPTIONS)
+        except ValueError as e:
+            logger.error(e)
+            return -1
+        if '--record' in opts and '--replay' in opts:
+            logger.error("cannot both record and replay a session")
+            return -1
+        try:
+            if '--record' in opts:
+                self.session = SessionRecorder(opts['--record'])
+            elif '--replay' in opts:
+                speed = float(opts.get('--speed', 1))
+                if speed <= 0:
+                    raise ValueError
+                self.session = SessionPlayer(opts['--replay'], speed)
+        except OSError as e:
+            logger.error("cannot open the session file: {}".format(e))
+            return -1
+        except ValueError:
+            logger.error("invalid --speed value")
+            return -1
+
+        try:
+            return self.diagnose_view(cmd, params, opts)
+        finally:
+            if self.session:
+                self.session.close()
+                self.session = None
+
+    def diagnose_view(self, cmd, params, opts):
+        if '--json' in opts:
+            return self.diagnose_json(cmd, opts)
         if cmd is None:
             return self.diagnosis_summary()
         if cmd == 'dns':
@@ -1033,11 +2318,15 @@ class diagnose(Module):
         if cmd == 'sip':
             return self.diagnose_sip()
         if cmd == 'memory':
-            return self.diagnose_mem()
+            return self.diagnose_mem(opts)
         if cmd == 'load':
             if not params:
                 params = ['udp', 'tcp', 'hep']
             return self.diagnose_load(params)
+        if cmd == 'dashboard':
+            return self.diagnose_dashboard()
+        if cmd == 'advise':
+            return self.diagnose_advise(opts)
 
     def __complete__(self, command, text, line, begidx, endidx):
         if command != 'load':
@@ -1050,13 +2339,157 @@ class diagnose(Module):
         ret = [t for t in transports if t.startswith(text)]
         return ret if ret else ['']
 
+    def __get_modifiers__(self):
+        return list(DIAGNOSE_OPTIONS.keys())
+
+    def __get_value_modifiers__(self):
+        return [o for o, value in DIAGNOSE_OPTIONS.items() if value]
+
     def __get_methods__(self):
-        return ['', 'sip', 'dns', 'sql', 'nosql', 'memory', 'load', 'brief', 'full']
+        return ['', 'sip', 'dns', 'sql', 'nosql', 'memory', 'load', 'dashboard',
+                'advise', 'brief', 'full']
 
     def __exclude__(self):
         valid = comm.valid()
         return (not valid[0], valid[1])
 
+def parse_iface(iface):
+    """
+    'udp:127.0.0.1:5060' or 'udp:[::1]:5060' -> ('udp', ip address, port)
+    """
+    try:
+        proto, _, addr = iface.partition(':')
+        host, _, port = addr.rpartition(':')
+        return proto, ipaddress.ip_address(host.strip('[]')), int(port)
+    except ValueError:
+        return None
+
+def decode_proc_addr(addr):
+    """
+    '0100007F:13C4' -> (127.0.0.1, 5060); the IPv4 and IPv6 addresses are
+    listed by the kernel as 32 bit words, in host byte order
+    """
+    ip, port = addr.split(':')
+    raw = bytes.fromhex(ip)
+    if sys.byteorder == 'little':
+        raw = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    return ipaddress.ip_address(raw), int(port, 16)
+
+def read_net_sockets():
+    """
+    parses the kernel socket tables into a dict keyed by the local address:
+    (proto, ip, port) -> rx_queue, tx_queue and drops (UDP only) counters
+    """
+    sockets = {}
+    for proto, path in NET_SOCKET_FILES:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            # only the listening TCP sockets are interesting
+            if proto == 'tcp' and fields[3] != TCP_LISTEN:
+                continue
+            try:
+                ip, port = decode_proc_addr(fields[1])
+                tx_queue, rx_queue = fields[4].split(':')
+                sockets[(proto, ip, port)] = {
+                    'rx_queue': int(rx_queue, 16),
+                    'tx_queue': int(tx_queue, 16),
+                    'drops': int(fields[12]) if proto == 'udp' else None,
+                    }
+            except (IndexError, ValueError):
+                continue
+    return sockets
+
+def read_net_snmp():
+    """
+    parses the kernel protocol counters into a dict, e.g. 'UdpInErrors' -> N
+    """
+    counters = {}
+    try:
+        with open('/proc/net/snmp') as f:
+            lines = f.readlines()
+        # each protocol has a line with the names, then one with the values
+        for names, values in zip(lines[::2], lines[1::2]):
+            proto, names = names.split(':', 1)
+            for name, value in zip(names.split(), values.split()[1:]):
+                counters[proto + name] = int(value)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/proc/net/snmp6') as f:
+            for line in f:
+                name, value = line.split()
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+def read_host_cpu():
+    """
+    returns the busy and the total CPU time of the host, from /proc/stat
+    """
+    try:
+        with open('/proc/stat') as f:
+            times = [int(t) for t in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # the idle and iowait times
+    idle = sum(times[3:5])
+    return sum(times) - idle, sum(times)
+
+def advise_pool_size(total, peak, headroom):
+    """
+    returns the advised size (MB) of a memory pool, given its peak usage,
+    or None if its current size is fine
+    """
+    mb = 1024 * 1024
+    size = math.ceil(peak * (100 + headroom) / 100 / mb)
+    # too small, or more than 4 times the size needed
+    if size * mb > total or size * mb * 4 < total:
+        return size
+    return None
+
+def advise_scale_out(cores_busy, cores, target):
+    """
+    checks if the CPU cores busy with the workers are over the target
+    utilisation of the host, in which case more workers would not help
+    """
+    return cores_busy > cores * target / 100
+
+def worst_severity(*severities):
+    """the most severe of the given severities"""
+    return max(severities, key=SEVERITIES.index)
+
+def load_severity(load):
+    """severity of a worker load percentage"""
+    if load > 80:
+        return "CRITICAL"
+    if load > 50:
+        return "WARNING"
+    return "OK"
+
+def mem_severity(usage_perc, max_usage_perc):
+    """severity of a memory pool, given its current and peak usage"""
+    if usage_perc <= 70 and max_usage_perc <= 80:
+        return "OK"
+    if usage_perc <= 85 and max_usage_perc <= 90:
+        return "WARNING"
+    return "CRITICAL"
+
+def slow_severity(slow_perc):
+    """severity of a percentage of slow operations"""
+    if 0 <= slow_perc <= 1:
+        return "OK"
+    if 2 <= slow_perc <= 5:
+        return "NOTICE"
+    if 6 <= slow_perc <= 50:
+        return "WARNING"
+    return "CRITICAL"
+
 def desc_sip_msg(sip_msg):
     """summarizes a SIP message into a useful one-liner"""
     try:
@@ -1083,6 +2516,25 @@ def desc_sip_msg(sip_msg):
 
     return "{}{}{}".format(desc, ", " if desc and callid else "", callid)
 
+def trend_severity(seconds):
+    """severity of a memory pool, given the seconds until it is exhausted"""
+    if seconds < 3600:
+        return "CRITICAL"
+    if seconds < 86400:
+        return "WARNING"
+    return "NOTICE"
+
+def human_duration(seconds):
+    """ Returns a human readable string representation of a duration"""
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return "{}d {}h".format(seconds // 86400, seconds % 86400 // 3600)
+    if seconds >= 3600:
+        return "{}h {}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m {}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
 def human_size(bytes, units=[' bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB']):
     """ Returns a human readable string representation of bytes"""
     return "{:.1f}".format(bytes) + units[0] \
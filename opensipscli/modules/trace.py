@@ -17,17 +17,38 @@
 ## along with this program. If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from collections import OrderedDict
 from datetime import datetime
 from time import time
+import bisect
+import heapq
+import ipaddress
+import os
+import re
 import random
+import selectors
 import socket
+import sqlite3
 from opensipscli import comm
 from opensipscli.config import cfg
 from opensipscli.logger import logger
 from opensipscli.module import Module
+from opensipscli.screen import Screen
 
 TRACE_BUFFER_SIZE = 65535
 
+# modifiers accepted by trace; True if they expect a value
+TRACE_OPTIONS = {
+    "--instances": True,
+    "--group-by": True,
+    "--stats": False,
+    "-w": True,
+    "--write": True,
+    "--calls": False,
+}
+
+TRACE_GROUP_BY = [ "call" ]
+
 '''
 find out more information here:
 * https://github.com/sipcapture/HEP/blob/master/docs/HEP3NetworkProtocolSpecification_REV26.pdf
@@ -51,6 +72,159 @@ protocol_ids = {
     num:name[8:] for name,num in vars(socket).items() if name.startswith("IPPROTO")
 }
 
+class SIPmessage(object):
+    """
+    lazy SIP parser: only the start line is parsed upfront, while the header
+    names are indexed on the first header lookup, and only their offsets
+    are stored; values are decoded when (and if) they are used
+    """
+
+    COMPACT_FORMS = {
+        "i": "call-id",
+        "f": "from",
+        "t": "to",
+        "v": "via",
+        "m": "contact",
+        "l": "content-length",
+        "c": "content-type",
+        "e": "content-encoding",
+        "k": "supported",
+        "s": "subject",
+    }
+
+    def __init__(self, data):
+        self.data = data
+        self.method = None
+        self.code = None
+        self.ruri = None
+        self.reason = None
+        self.__index = None
+
+        eol = data.find(b"\r\n")
+        if eol < 0:
+            eol = len(data)
+        self.hdr_start = eol + 2
+        parts = data[:eol].decode(errors="replace").split(" ", 2)
+        if len(parts) < 2:
+            return
+        if parts[0] == "SIP/2.0":
+            try:
+                self.code = int(parts[1])
+            except ValueError:
+                return
+            self.reason = parts[2] if len(parts) > 2 else ""
+        else:
+            self.method = parts[0]
+            self.ruri = parts[1]
+
+    def is_request(self):
+        return self.method is not None
+
+    def is_valid(self):
+        return self.method is not None or self.code is not None
+
+    def __build_index(self):
+        self.__index = {}
+        data = self.data
+        end = data.find(b"\r\n\r\n", self.hdr_start)
+        if end < 0:
+            end = len(data)
+        pos = self.hdr_start
+        last = None
+        while pos < end:
+            eol = data.find(b"\r\n", pos, end)
+            if eol < 0:
+                eol = end
+            if data[pos:pos + 1] in (b" ", b"\t"):
+                # folded header - extend the previous one
+                if last is not None:
+                    last[1] = eol
+                pos = eol + 2
+                continue
+            colon = data.find(b":", pos, eol)
+            if colon > pos:
+                name = data[pos:colon].strip().decode(errors="replace").lower()
+                name = self.COMPACT_FORMS.get(name, name)
+                last = [colon + 1, eol]
+                self.__index.setdefault(name, []).append(last)
+            pos = eol + 2
+
+    def headers(self, name):
+        """
+        returns all the values of a header
+        """
+        if self.__index is None:
+            self.__build_index()
+        return [self.data[s:e].decode(errors="replace").strip()
+                for s, e in self.__index.get(name.lower(), [])]
+
+    def header(self, name):
+        """
+        returns the first value of a header, or None if not present
+        """
+        if self.__index is None:
+            self.__build_index()
+        offsets = self.__index.get(name.lower())
+        if not offsets:
+            return None
+        s, e = offsets[0]
+        return self.data[s:e].decode(errors="replace").strip()
+
+    def callid(self):
+        return self.header("call-id")
+
+    def cseq(self):
+        """
+        returns the CSeq number and method, or (None, None)
+        """
+        cseq = self.header("cseq")
+        try:
+            num, method = cseq.split()
+            return int(num), method
+        except (AttributeError, ValueError):
+            return None, None
+
+    def via_branch(self):
+        """
+        returns the branch parameter of the topmost Via
+        """
+        via = self.header("via")
+        if via is None:
+            return None
+        for param in via.split(",")[0].split(";")[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "branch":
+                return value.strip()
+        return None
+
+    def uri_user(self, name):
+        """
+        returns the user part of the URI of a From/To like header
+        """
+        value = self.header(name)
+        if value is None:
+            return None
+        lt = value.find("<")
+        if lt >= 0:
+            value = value[lt + 1:value.find(">", lt)]
+        else:
+            value = value.split(";")[0]
+        value = value.split(":", 1)[-1]
+        if "@" not in value:
+            return None
+        return value.split("@")[0].split(";")[0]
+
+    def summary(self):
+        """
+        returns a one-line description of the message
+        """
+        if self.method:
+            return self.method
+        if self.code is not None:
+            return "{} {} ({})".format(self.code, self.reason,
+                    self.cseq()[1] or "?")
+        return "???"
+
 class HEPpacketException(Exception):
     pass
 
@@ -66,13 +240,43 @@ class HEPpacket(object):
         self.dst_port = None
         self.data = None
         self.correlation = None
+        self.type = protocol_types[0x00]
+        self.instance = None
+        self.sip = None
         self.ts = time()
         self.tms = datetime.now().microsecond
 
+    def get_sip(self):
+        """
+        returns the (lazily) parsed SIP message, or None if not SIP
+        """
+        if self.sip is None and self.type == "SIP" and self.data:
+            self.sip = SIPmessage(self.data)
+        return self.sip
+
+    def addresses(self):
+        """
+        returns the source and destination, in the 'ip:port' format
+        """
+        try:
+            return "{}:{}".format(socket.inet_ntop(self.family, self.src_addr),
+                    self.src_port), "{}:{}".format(
+                    socket.inet_ntop(self.family, self.dst_addr), self.dst_port)
+        except (TypeError, ValueError, OSError):
+            return "?", "?"
+
+    def timestamp(self):
+        """
+        returns the HEP timestamp, in microseconds
+        """
+        return int(self.ts) * 1000000 + self.tms
+
     def __str__(self):
         time_str = "{}.{}".format(
                 self.ts,
                 self.tms)
+        if self.instance:
+            time_str = "{} [{}]".format(time_str, self.instance)
         protocol_str = " {}/{}".format(
                 self.protocol,
                 self.type)
@@ -173,25 +377,40 @@ class HEPpacket(object):
         else:
             logger.warning("unhandled payload type {}".format(type_id))
 
-class trace(Module):
+class HEPstream(object):
+    """
+    reassembles the HEPv3 packets received over a TCP connection
+    """
 
-    def __print_hep(self, packet):
-        # this works as a HEP parser
+    def __init__(self, conn, instance=None):
+        self.conn = conn
+        self.instance = instance
+        self.buffer = b''
+
+    def feed(self, data):
+        """
+        returns the list of complete packets, or None on parsing errors
+        """
+        packet = self.buffer + data
         logger.debug("initial packet size is {}".format(len(packet)))
 
+        packets = []
         while len(packet) > 0:
-            if len(packet) < 4:
-                return packet
+            if len(packet) < 6:
+                break
             # currently only HEPv3 is accepted
             if packet[0:4] != b'HEP3':
                 logger.warning("packet not HEPv3: [{}]".format(packet[0:4]))
                 return None
             length = int.from_bytes(packet[4:6], byteorder="big", signed=False)
+            if length < 6:
+                logger.warning("invalid HEP packet length {}".format(length))
+                return None
             if length > len(packet):
                 logger.debug("partial packet: {} out of {}".
                         format(len(packet), length))
                 # wait for entire packet to parse it
-                return packet
+                break
             logger.debug("packet size is {}".format(length))
             # skip the header
             hep_packet = HEPpacket(packet[6:length])
@@ -199,23 +418,671 @@ class trace(Module):
                 hep_packet.parse()
             except HEPpacketException:
                 return None
+            hep_packet.instance = self.instance
             packet = packet[length:]
-            print(hep_packet)
+            packets.append(hep_packet)
+
+        self.buffer = packet
+        return packets
+
+class HEPmerger(object):
+    """
+    k-way merge of the HEP packets received from several streams, in the
+    order of their HEP timestamp; a packet is released once all the streams
+    went past it, or after it has been held for the reorder window
+    """
+
+    def __init__(self, output, window, streams):
+        self.output = output
+        self.window = window
+        self.window_us = int(window * 1000000)
+        self.heap = []
+        self.seq = 0
+        # nothing is released by timestamp until every stream has spoken
+        self.marks = { s: 0 for s in streams }
+
+    def push(self, packet):
+        ts = packet.timestamp()
+        if ts > self.marks.get(packet.instance, 0):
+            self.marks[packet.instance] = ts
+        # seq keeps the arrival order for packets with identical timestamps
+        heapq.heappush(self.heap, (ts, self.seq, time(), packet))
+        self.seq += 1
+
+    def remove(self, instance):
+        self.marks.pop(instance, None)
+
+    def flush(self, force=False):
+        now = time()
+        if self.marks:
+            low = min(self.marks.values()) - self.window_us
+        else:
+            low = None
+        while self.heap:
+            ts, _, arrival, packet = self.heap[0]
+            if not force and arrival + self.window > now and \
+                    (low is None or ts > low):
+                break
+            heapq.heappop(self.heap)
+            self.output(packet)
+
+class SIPcall(object):
+    """
+    the messages seen for a Call-ID, kept as one-line summaries
+    """
+
+    def __init__(self, key, now):
+        self.key = key
+        self.method = None
+        self.caller = None
+        self.callee = None
+        self.first_ts = None
+        self.last_ts = None
+        self.last_seen = now
+        self.ended = None
+        self.messages = []
+        self.dropped = 0
+        self.correlations = []
+
+class CallTracker(object):
+    """
+    groups the traced packets by call, into a LRU bounded table, and prints
+    a ladder summary of each call when it ends, times out or is evicted
+    """
+
+    # seconds to wait for retransmissions and the other legs of a call
+    CALL_LINGER = 2
+    # maximum number of messages kept in a call's ladder
+    CALL_MAX_MESSAGES = 100
+
+    def __init__(self, output, timeout, max_calls):
+        self.output = output
+        self.timeout = timeout
+        self.max_calls = max_calls
+        self.calls = OrderedDict()
+        self.ended = set()
+        self.correlations = {}
+
+    def get_key(self, packet, sip):
+        callid = sip.callid() if sip else None
+        if callid:
+            return callid
+        if packet.correlation:
+            try:
+                return self.correlations[packet.correlation]
+            except KeyError:
+                return packet.correlation.decode(errors="replace")
+        return None
+
+    def push(self, packet):
+        now = time()
+        sip = packet.get_sip()
+        if sip and not sip.is_valid():
+            sip = None
+        key = self.get_key(packet, sip)
+        if key is None:
+            # nothing to group by
+            self.output(str(packet))
+            return
+
+        try:
+            call = self.calls[key]
+            self.calls.move_to_end(key)
+        except KeyError:
+            call = SIPcall(key, now)
+            self.calls[key] = call
+            if len(self.calls) > self.max_calls:
+                self.remove(next(iter(self.calls)), "evicted")
+
+        if packet.correlation and packet.correlation not in self.correlations:
+            self.correlations[packet.correlation] = key
+            call.correlations.append(packet.correlation)
+
+        ts = packet.timestamp()
+        if call.first_ts is None:
+            call.first_ts = ts
+        call.last_ts = ts
+        call.last_seen = now
+
+        if sip:
+            src, dst = packet.addresses()
+            desc = "{} -> {} {}".format(src, dst, sip.summary())
+            if sip.is_request() and call.method is None:
+                call.method = sip.method
+                call.caller = sip.uri_user("from")
+                call.callee = sip.uri_user("to")
+            self.check_end(call, sip, now)
+        else:
+            desc = "{}: {}".format(packet.type, packet.data.decode(
+                errors="replace").strip().split("\n")[0] \
+                        if packet.data else "")
+
+        if len(call.messages) < self.CALL_MAX_MESSAGES:
+            call.messages.append((ts, packet.instance, desc))
+        else:
+            call.dropped += 1
+
+    def check_end(self, call, sip, now):
+        if sip.is_request() or sip.code < 200:
+            return
+        cseq_method = sip.cseq()[1]
+        if cseq_method == "BYE" or (cseq_method == call.method and \
+                (call.method != "INVITE" or sip.code >= 300)):
+            if call.ended is None:
+                call.ended = now
+                self.ended.add(call.key)
+
+    def remove(self, key, reason):
+        call = self.calls.pop(key)
+        self.ended.discard(key)
+        for c in call.correlations:
+            self.correlations.pop(c, None)
+        self.output(self.format_call(call, reason))
+
+    def flush(self, force=False):
+        now = time()
+        expired = {}
+        # calls are kept in LRU order, so the idle ones are at the front
+        for key, call in self.calls.items():
+            if call.last_seen + self.timeout <= now:
+                reason = "timed out"
+            elif force:
+                reason = "in progress"
+            else:
+                break
+            expired[key] = "completed" if call.ended else reason
+        for key in self.ended:
+            call = self.calls.get(key)
+            if call and key not in expired and \
+                    call.ended + self.CALL_LINGER <= now:
+                expired[key] = "completed"
+        for key, reason in expired.items():
+            self.remove(key, reason)
+
+    def format_call(self, call, reason):
+        duration = (call.last_ts - call.first_ts) / 1000000
+        header = "Call-ID: {}".format(call.key)
+        if call.method:
+            header += " {} {} -> {}".format(call.method,
+                    call.caller or "?", call.callee or "?")
+        header += " ({} messages, {:.3f}s, {})".format(
+                len(call.messages) + call.dropped, duration, reason)
+        lines = [logger.color(logger.BLUE, header)]
+        for ts, instance, desc in call.messages:
+            lines.append("    {}.{:06d}{} {}".format(
+                datetime.fromtimestamp(ts // 1000000).strftime("%H:%M:%S"),
+                ts % 1000000, " [{}]".format(instance) if instance else "",
+                desc))
+        if call.dropped:
+            lines.append("    ... {} more messages".format(call.dropped))
+        return "\n".join(lines)
+
+class LatencyHistogram(object):
+    """
+    log-scale latency histogram, with the bucket limits in milliseconds
+    """
+
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+        self.total += 1
+
+    def percentile(self, perc):
+        """
+        returns the upper limit of the bucket holding the percentile
+        """
+        if self.total == 0:
+            return "-"
+        rank = self.total * perc / 100
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if idx == len(self.BUCKETS):
+            return ">{}".format(self.BUCKETS[-1])
+        return "<{}".format(self.BUCKETS[idx])
+
+class SIPmethodStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.last_requests = 0
+        self.replies = [0] * 6
+        self.first_reply = LatencyHistogram()
+        self.final_reply = LatencyHistogram()
+
+class SIPstats(object):
+    """
+    aggregates the traced SIP traffic, instead of printing it: per method
+    request rates, reply classes, and request to reply latencies, measured
+    by matching each transaction on its top Via branch and CSeq
+    """
+
+    # seconds after which an unanswered transaction is dropped
+    TRANSACTION_TIMEOUT = 32
+    # maximum number of open transactions tracked
+    MAX_TRANSACTIONS = 100000
+
+    def __init__(self, output):
+        self.output = output
+        self.methods = {}
+        self.transactions = OrderedDict()
+        self.start = time()
+        self.last_render = self.start
+        self.packets = 0
+        self.expired = 0
+        self.last_ts = 0
+
+    def get_method(self, method):
+        try:
+            return self.methods[method]
+        except KeyError:
+            stats = SIPmethodStats()
+            self.methods[method] = stats
+            return stats
+
+    def push(self, packet):
+        self.packets += 1
+        sip = packet.get_sip()
+        if not sip or not sip.is_valid():
+            return
+        num, method = sip.cseq()
+        key = (sip.via_branch(), num, method)
+        ts = packet.timestamp()
+        if ts > self.last_ts:
+            self.last_ts = ts
+
+        if sip.is_request():
+            self.get_method(sip.method).requests += 1
+            if sip.method == "ACK" or key in self.transactions:
+                # no reply expected, or a retransmission
+                return
+            # [start time, first reply seen]
+            self.transactions[key] = [ts, False]
+            if len(self.transactions) > self.MAX_TRANSACTIONS:
+                self.transactions.popitem(last=False)
+                self.expired += 1
+            return
+
+        if method is None:
+            return
+        stats = self.get_method(method)
+        if 100 <= sip.code < 700:
+            stats.replies[sip.code // 100 - 1] += 1
+        trans = self.transactions.get(key)
+        if trans is None:
+            return
+        latency = max(ts - trans[0], 0) / 1000
+        if not trans[1]:
+            stats.first_reply.add(latency)
+            trans[1] = True
+        if sip.code >= 200:
+            stats.final_reply.add(latency)
+            del self.transactions[key]
+
+    def expire(self):
+        # transactions are timed by OpenSIPS' clock, not the local one
+        limit = self.last_ts - self.TRANSACTION_TIMEOUT * 1000000
+        while self.transactions:
+            key, trans = next(iter(self.transactions.items()))
+            if trans[0] > limit:
+                break
+            del self.transactions[key]
+            self.expired += 1
+
+    def flush(self, force=False):
+        now = time()
+        if not force and now < self.last_render + 1:
+            return
+        self.expire()
+        elapsed = now - self.last_render
+        self.last_render = now
+        self.output(self.render(elapsed))
 
-        return packet
+    def render(self, elapsed):
+        lines = ["{}SIP Traffic Statistics".format(25 * " "), "",
+            "Running for {} seconds, {} packets, {} open / {} expired "
+            "transactions".format(int(self.last_render - self.start),
+                self.packets, len(self.transactions), self.expired), "",
+            "{:<10} {:>7} {:>9} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7}"
+            "  {:>6} {:>6}  {:>6} {:>6}".format("Method", "req/s", "requests",
+                "1xx", "2xx", "3xx", "4xx", "5xx", "6xx",
+                "1st50", "1st90", "fin50", "fin90")]
+        for method in sorted(self.methods,
+                key=lambda m: self.methods[m].requests, reverse=True):
+            stats = self.methods[method]
+            rate = (stats.requests - stats.last_requests) / elapsed \
+                    if elapsed > 0 else 0
+            stats.last_requests = stats.requests
+            lines.append("{:<10} {:>7.1f} {:>9} {:>7} {:>7} {:>7} {:>7} {:>7}"
+                " {:>7}  {:>6} {:>6}  {:>6} {:>6}".format(method[:10], rate,
+                    stats.requests, *stats.replies,
+                    stats.first_reply.percentile(50),
+                    stats.first_reply.percentile(90),
+                    stats.final_reply.percentile(50),
+                    stats.final_reply.percentile(90)))
+        lines.append("")
+        lines.append("Info: latencies are in ms, measured from a request to its "
+                "first (1st)")
+        lines.append("      and final (fin) reply, as 50th/90th percentiles.")
+        return "\n".join(lines)
+
+def compile_filters(filters):
+    """
+    compiles the client-side filters (name=value) into a single predicate
+    that runs against a HEP packet; checks are ordered by their cost, so
+    that the HEP fields are matched before parsing the SIP message
+    """
+    checks = []
+    for f in filters:
+        name, _, value = f.partition("=")
+        if value == "":
+            raise ValueError("no value given for filter '{}'".format(name))
+        cost, check = TRACE_CLIENT_FILTERS[name](value)
+        checks.append((cost, len(checks), check))
+    checks = [c[2] for c in sorted(checks)]
+
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+
+    def match(packet):
+        for check in checks:
+            if not check(packet):
+                return False
+        return True
+    return match
+
+def filter_type(value):
+    types = set(t.strip().upper() for t in value.split(","))
+    known = set(protocol_types.values())
+    for t in types:
+        if t not in known:
+            raise ValueError("unknown payload type '{}', use one of: {}".
+                    format(t, ", ".join(sorted(known))))
+    return 0, lambda packet: packet.type in types
+
+def filter_transport(value):
+    transports = set(t.strip().upper() for t in value.split(","))
+    return 0, lambda packet: packet.protocol in transports
+
+def filter_address(value, attr):
+    try:
+        net = ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        raise ValueError("invalid network '{}'".format(value))
+    size = 4 if net.version == 4 else 16
+    addr = int(net.network_address)
+    mask = int(net.netmask)
+
+    def check(packet):
+        raw = getattr(packet, attr)
+        return raw is not None and len(raw) == size and \
+                int.from_bytes(raw, byteorder="big") & mask == addr
+    return 1, check
+
+def filter_method(value):
+    methods = set(m.strip().upper() for m in value.split(","))
+
+    def check(packet):
+        sip = packet.get_sip()
+        if not sip:
+            return False
+        if sip.method is not None:
+            return sip.method in methods
+        return sip.code is not None and sip.cseq()[1] in methods
+    # replies need their CSeq header parsed, requests do not
+    return 2, check
+
+def filter_code(value):
+    try:
+        if len(value) == 3 and value[1:].lower() == "xx":
+            low = int(value[0]) * 100
+            high = low + 99
+        else:
+            low, _, high = value.partition("-")
+            low = int(low)
+            high = int(high) if high else low
+    except ValueError:
+        raise ValueError("invalid code range '{}'".format(value))
+
+    def check(packet):
+        sip = packet.get_sip()
+        return sip is not None and sip.code is not None and \
+                low <= sip.code <= high
+    return 2, check
+
+def filter_header(value):
+    name, sep, regex = value.partition(":")
+    if not sep or not name:
+        raise ValueError("header filter format is 'header=Name:regex'")
+    try:
+        regex = re.compile(regex)
+    except re.error as e:
+        raise ValueError("invalid regex '{}': {}".format(regex, e))
+
+    def check(packet):
+        sip = packet.get_sip()
+        if not sip:
+            return False
+        return any(regex.search(v) for v in sip.headers(name))
+    return 3, check
+
+# filters evaluated by opensips-cli, as opposed to the ones trace_start
+# accepts; each returns its relative cost and the check itself
+TRACE_CLIENT_FILTERS = {
+    "type": filter_type,
+    "transport": filter_transport,
+    "src": lambda value: filter_address(value, "src_addr"),
+    "dst": lambda value: filter_address(value, "dst_addr"),
+    "method": filter_method,
+    "code": filter_code,
+    "header": filter_header,
+}
+
+class TraceStore(object):
+    """
+    stores the traced packets, along with their parsed SIP fields, in a
+    local SQLite database; rows are written in batches
+    """
+
+    BATCH_SIZE = 1000
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            instance TEXT,
+            protocol TEXT,
+            type TEXT,
+            src_ip BLOB,
+            src_port INTEGER,
+            dst_ip BLOB,
+            dst_port INTEGER,
+            method TEXT,
+            code INTEGER,
+            callid TEXT,
+            from_user TEXT,
+            to_user TEXT,
+            correlation TEXT,
+            data BLOB)""",
+        "CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts)",
+        "CREATE INDEX IF NOT EXISTS messages_callid ON messages (callid)",
+        "CREATE INDEX IF NOT EXISTS messages_from ON messages (from_user)",
+        "CREATE INDEX IF NOT EXISTS messages_to ON messages (to_user)",
+        "CREATE INDEX IF NOT EXISTS messages_src ON messages (src_ip)",
+        "CREATE INDEX IF NOT EXISTS messages_method ON messages (method)",
+    ]
+
+    COLUMNS = ["ts", "instance", "protocol", "type", "src_ip", "src_port",
+            "dst_ip", "dst_port", "method", "code", "callid", "from_user",
+            "to_user", "correlation", "data"]
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.insert = "INSERT INTO messages ({}) VALUES ({})".format(
+                ", ".join(self.COLUMNS), ", ".join(["?"] * len(self.COLUMNS)))
+        self.rows = []
+        self.stored = 0
+
+    def push(self, packet):
+        method = code = callid = from_user = to_user = None
+        sip = packet.get_sip()
+        if sip and sip.is_valid():
+            method = sip.method or sip.cseq()[1]
+            code = sip.code
+            callid = sip.callid()
+            from_user = sip.uri_user("from")
+            to_user = sip.uri_user("to")
+        correlation = packet.correlation.decode(errors="replace") \
+                if packet.correlation else None
+        self.rows.append((packet.timestamp(), packet.instance,
+            packet.protocol, packet.type, packet.src_addr, packet.src_port,
+            packet.dst_addr, packet.dst_port, method, code, callid,
+            from_user, to_user, correlation, packet.data))
+        if len(self.rows) >= self.BATCH_SIZE:
+            self.write()
+
+    def write(self):
+        if not self.rows:
+            return
+        with self.db:
+            self.db.executemany(self.insert, self.rows)
+        self.stored += len(self.rows)
+        self.rows = []
+
+    def flush(self, force=False):
+        self.write()
+        if force:
+            self.db.close()
+            logger.info("{} messages stored in {}".format(
+                self.stored, self.path))
+
+def query_time(value, day):
+    """
+    parses a query time, either as an epoch, as a 'YYYY-mm-dd HH:MM[:SS]'
+    date or as a 'HH:MM[:SS]' time of the given day; returns microseconds
+    """
+    try:
+        return int(float(value) * 1000000)
+    except ValueError:
+        pass
+    for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%H:%M:%S", "%H:%M"]:
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if not fmt.startswith("%Y"):
+            parsed = datetime.combine(day, parsed.time())
+        return int(parsed.timestamp() * 1000000)
+    raise ValueError("invalid time '{}'".format(value))
+
+def query_network(value):
+    try:
+        net = ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        raise ValueError("invalid network '{}'".format(value))
+    return net.network_address.packed, net.broadcast_address.packed
+
+def build_query(db, filters, calls=False):
+    """
+    builds the SQL query (and its arguments) of the given filters
+    """
+    conds = []
+    args = []
+    day = None
+    for f in filters:
+        name, _, value = f.partition("=")
+        if value == "":
+            raise ValueError("no value given for filter '{}'".format(name))
+        if name in ["start", "end"]:
+            if day is None:
+                # times of day refer to the day of the last message stored
+                last = db.execute("SELECT MAX(ts) FROM messages").fetchone()[0]
+                day = datetime.fromtimestamp((last or time() * 1000000) /
+                        1000000).date()
+            conds.append("ts >= ?" if name == "start" else "ts <= ?")
+            args.append(query_time(value, day))
+        elif name in ["src", "dst"]:
+            low, high = query_network(value)
+            conds.append("{0}_ip BETWEEN ? AND ? AND length({0}_ip) = ?".
+                    format(name))
+            args += [low, high, len(low)]
+        elif name in ["callid", "method"]:
+            values = value.split(",")
+            if name == "method":
+                values = [v.upper() for v in values]
+            conds.append("{} IN ({})".format(name,
+                ", ".join(["?"] * len(values))))
+            args += values
+        elif name in ["caller", "callee"]:
+            conds.append("{} = ?".format(
+                "from_user" if name == "caller" else "to_user"))
+            args.append(value.split("@")[0])
+        elif name == "code":
+            if len(value) == 3 and value[1:].lower() == "xx":
+                low = int(value[0]) * 100
+                high = low + 99
+            else:
+                low, _, high = value.partition("-")
+                try:
+                    low = int(low)
+                    high = int(high) if high else low
+                except ValueError:
+                    raise ValueError("invalid code range '{}'".format(value))
+            conds.append("code BETWEEN ? AND ?")
+            args += [low, high]
+        else:
+            raise ValueError("unknown query filter '{}'".format(name))
+
+    where = " WHERE " + " AND ".join(conds) if conds else ""
+    columns = ", ".join(TraceStore.COLUMNS)
+    if calls:
+        query = "SELECT {} FROM messages WHERE callid IN " \
+                "(SELECT DISTINCT callid FROM messages{}{} callid " \
+                "IS NOT NULL) ORDER BY ts, id".format(columns, where,
+                        " AND" if where else " WHERE")
+    else:
+        query = "SELECT {} FROM messages{} ORDER BY ts, id".format(
+                columns, where)
+    return query, args
+
+class trace(Module):
+
+    def __print_hep(self, packet):
+        print(packet)
+
+    def __print_stats(self, stats):
+        with self.screen.frame():
+            print(stats)
+            print("\n{}(press Ctrl-c to exit)".format('\t' * 5))
 
     def __complete__(self, command, text, line, begidx, endidx):
-        filters = [ "caller", "callee", "ip" ]
+        filters = [ "caller", "callee", "ip" ] + list(TRACE_CLIENT_FILTERS)
 
         # remove the filters already used
-        filters = [f for f in filters if line.find(f + "=") == -1]
+        filters = [f for f in filters if f == "header" or \
+                line.find(f + "=") == -1]
         if not command:
             return filters
 
         if (not text or text == "") and line[-1] == "=":
             return [""]
 
-        ret = [f for f in filters if (f.startswith(text) and line.find(f + "=") == -1)]
+        ret = [f for f in filters if f.startswith(text)]
         if len(ret) == 1 :
             ret[0] = ret[0] + "="
         return ret
@@ -223,11 +1090,102 @@ class trace(Module):
     def __get_methods__(self):
         return None
 
+    def __get_modifiers__(self):
+        return list(TRACE_OPTIONS.keys())
+
+    def __get_value_modifiers__(self):
+        return [o for o, value in TRACE_OPTIONS.items() if value]
+
+    def get_instances(self, opts):
+        if "--instances" not in opts:
+            return [None]
+        instances = [i.strip() for i in opts["--instances"].split(",")
+                if i.strip() != ""]
+        for i in instances:
+            if not cfg.has_instance(i):
+                logger.error("instance '{}' not found!".format(i))
+                return None
+        if len(set(instances)) != len(instances):
+            logger.error("duplicate instances in '{}'".
+                    format(opts["--instances"]))
+            return None
+        return instances
+
+    def trace_listen(self, instance, used):
+        options = cfg.to_dict(instance)
+        trace_ip = options["trace_listen_ip"]
+        trace_port = int(options["trace_listen_port"])
+        # instances sharing the same listener settings get consecutive ports
+        while trace_port != 0 and (trace_ip, trace_port) in used:
+            trace_port += 1
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((trace_ip, trace_port))
+        if trace_port == 0:
+            trace_port = s.getsockname()[1]
+        used.add((trace_ip, trace_port))
+        s.listen(1)
+        return s, "hep:{}:{};transport=tcp;version=3".format(
+                trace_ip, trace_port)
+
+    def trace_query(self, params, calls):
+        if len(params) < 1:
+            logger.error("no trace store specified!")
+            return -1
+        path = params[0]
+        if not os.path.isfile(path):
+            logger.error("trace store {} not found!".format(path))
+            return -1
+        db = sqlite3.connect(path)
+        try:
+            query, args = build_query(db, params[1:], calls)
+            logger.debug("running '{}' with {}".format(query, args))
+            for row in db.execute(query, args):
+                row = dict(zip(TraceStore.COLUMNS, row))
+                packet = HEPpacket(None)
+                packet.ts, packet.tms = divmod(row["ts"], 1000000)
+                for attr in ["instance", "protocol", "type", "src_addr",
+                        "src_port", "dst_addr", "dst_port", "data"]:
+                    setattr(packet, attr, row[attr.replace("addr", "ip")])
+                if packet.src_addr and len(packet.src_addr) == 16:
+                    packet.family = socket.AF_INET6
+                self.__print_hep(packet)
+        except (ValueError, sqlite3.Error) as e:
+            logger.error(e)
+            return -1
+        finally:
+            db.close()
+
     def do_trace(self, params, modifiers):
 
         filters = []
+        prompt = params is None
+
+        try:
+            opts, params = self.parse_options(
+                    (modifiers or []) + (params or []), TRACE_OPTIONS)
+        except ValueError as e:
+            logger.error(e)
+            return -1
+
+        if params and params[0] == "query":
+            return self.trace_query(params[1:], "--calls" in opts)
+
+        instances = self.get_instances(opts)
+        if not instances:
+            return -1
 
-        if params is None:
+        # filters only opensips-cli knows about are not sent to OpenSIPS
+        client_filters = [p for p in params
+                if p.partition("=")[0] in TRACE_CLIENT_FILTERS]
+        params = [p for p in params if p not in client_filters]
+        try:
+            match = compile_filters(client_filters)
+        except ValueError as e:
+            logger.error(e)
+            return -1
+
+        if prompt:
             caller_f = input("Caller filter: ")
             if caller_f != "":
                 filters.append("caller={}".format(caller_f))
@@ -246,46 +1204,116 @@ class trace(Module):
         else:
             filters = params
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        trace_ip = cfg.get("trace_listen_ip")
-        trace_port = int(cfg.get("trace_listen_port"))
-        s.bind((trace_ip, trace_port))
-        if trace_port == 0:
-            trace_port = s.getsockname()[1]
-        s.listen(1)
-        conn = None
         trace_name = "opensips-cli.{}".format(random.randint(0, 65536))
-        trace_socket = "hep:{}:{};transport=tcp;version=3".format(
-                trace_ip, trace_port)
-        args = {
-            'id': trace_name,
-            'uri': trace_socket,
-        }
-        if filters:
-            args['filter'] = filters
-
         logger.debug("filters are {}".format(filters))
-        trace_started = comm.execute('trace_start', args)
-        if not trace_started:
-            return False
 
+        # packets flow through the merger (if any), then to the sinks
+        sinks = []
+        timeout = None
+        if "--group-by" in opts:
+            if opts["--group-by"] not in TRACE_GROUP_BY:
+                logger.error("cannot group by '{}', use one of: {}".format(
+                    opts["--group-by"], ", ".join(TRACE_GROUP_BY)))
+                return -1
+            sinks.append(CallTracker(print, int(cfg.get("trace_call_timeout")),
+                    int(cfg.get("trace_max_calls"))))
+            timeout = 1
+        if "--stats" in opts:
+            if sinks:
+                logger.error("cannot use '--stats' and '--group-by' together")
+                return -1
+            self.screen = Screen()
+            sinks.append(SIPstats(self.__print_stats))
+            timeout = 1
+        store_path = opts.get("-w", opts.get("--write"))
+        if store_path:
+            try:
+                sinks.append(TraceStore(store_path))
+            except sqlite3.Error as e:
+                logger.error("cannot open trace store {}: {}".format(
+                    store_path, e))
+                return -1
+            timeout = 1
+
+        if not sinks:
+            push = self.__print_hep
+        elif len(sinks) == 1:
+            push = sinks[0].push
+        else:
+            def push(packet):
+                for sink in sinks:
+                    sink.push(packet)
+
+        if len(instances) > 1:
+            window = int(cfg.get("trace_reorder_window")) / 1000
+            merger = HEPmerger(push, window, instances)
+            push = merger.push
+            timeout = window if timeout is None else min(timeout, window)
+            outputs = [merger] + sinks
+        else:
+            outputs = sinks
+
+        sel = selectors.DefaultSelector()
+        started = []
+        used = set()
         try:
-            conn, addr = s.accept()
-            logger.debug("New TCP connection from {}:{}".
-                    format(addr[0], addr[1]))
-            remaining = b''
-            while True:
-                data = conn.recv(TRACE_BUFFER_SIZE)
-                if not data:
-                    break
-                remaining = self.__print_hep(remaining + data)
-                if remaining is None:
-                    break
+            for instance in instances:
+                handler = comm.get_handler(instance)
+                if handler is None:
+                    return -1
+                s, trace_socket = self.trace_listen(instance, used)
+                sel.register(s, selectors.EVENT_READ, (instance, None))
+                args = {
+                    'id': trace_name,
+                    'uri': trace_socket,
+                }
+                if filters:
+                    args['filter'] = filters
+                trace_started = comm.execute('trace_start', args,
+                        handler=handler)
+                if not trace_started:
+                    return False
+                started.append(handler)
+
+            pending = set(instances)
+            connections = 0
+            while pending or connections > 0:
+                for key, _ in sel.select(timeout):
+                    instance, stream = key.data
+                    if stream is None:
+                        conn, addr = key.fileobj.accept()
+                        logger.debug("New TCP connection from {}:{}".
+                                format(addr[0], addr[1]))
+                        sel.register(conn, selectors.EVENT_READ,
+                                (instance, HEPstream(conn, instance)))
+                        connections += 1
+                        continue
+                    data = stream.conn.recv(TRACE_BUFFER_SIZE)
+                    packets = stream.feed(data) if data else None
+                    if packets is None:
+                        sel.unregister(stream.conn)
+                        stream.conn.close()
+                        connections -= 1
+                        pending.discard(instance)
+                        if len(instances) > 1:
+                            merger.remove(instance)
+                        continue
+                    for packet in packets:
+                        if match is None or match(packet):
+                            push(packet)
+                for output in outputs:
+                    output.flush()
         except KeyboardInterrupt:
-            comm.execute('trace_stop', {'id' : trace_name }, True)
-            if conn is not None:
-                conn.close()
+            pass
+        finally:
+            for output in outputs:
+                output.flush(True)
+            for handler in started:
+                comm.execute('trace_stop', {'id' : trace_name }, True,
+                        handler=handler)
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            sel.close()
 
     def __exclude__(self):
         valid = comm.valid()
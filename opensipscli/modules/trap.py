@@ -22,12 +22,304 @@ from opensipscli.logger import logger
 from opensipscli.config import cfg
 from opensipscli import comm
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
 import subprocess
 import shutil
+import codecs
+import gzip
+import pwd
+import queue
+import time
 import os
+import re
 
 DEFAULT_PROCESS_NAME = 'opensips'
 
+# seconds to wait for a terminated gdb to detach, before killing it
+GDB_TERM_TIMEOUT = 5
+
+# separates the output of each process in a single gdb session
+GDB_PID_MARKER = "---trap-pid "
+GDB_PID_MARKER_RE = re.compile(r"^{}(\d+|end)$".format(GDB_PID_MARKER))
+
+# the function of a gdb frame, without its address, arguments and locals
+GDB_FRAME_RE = re.compile(r"^#\d+\s+(?:0x[0-9a-fA-F]+ in )?(<[^>]*>|[^\s(]+)")
+
+# number of frames of a stack shown in the summary of the trap
+TRAP_SUMMARY_DEPTH = 8
+
+TRAP_OPTIONS = {
+    '--jobs': True,
+    '--timeout': True,
+    '--single-gdb': False,
+    '--compress': False,
+    '--sample': True,
+    '--interval': True,
+    '--duration': True,
+    '--gdb': False,
+}
+
+# separates the parts of the analysis of a core
+GDB_CORE_MARKER = "---trap-core "
+GDB_CORE_MARKER_RE = re.compile(r"^{}(\w+)$".format(GDB_CORE_MARKER))
+
+# a value printed by gdb, and the first string in it, with its escapes
+GDB_VALUE_RE = re.compile(r"^\$\d+ = ", re.M)
+GDB_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+# a process this loaded that does not progress is considered stuck
+WATCH_STUCK_LOAD = 100
+
+# strips the prompts of an interactive gdb from its output
+GDB_PROMPT_RE = re.compile(r"^(\(gdb\) )+")
+
+def stop_gdb(gdb):
+    # a terminated gdb still detaches from the process it traces
+    gdb.terminate()
+    try:
+        gdb.wait(timeout=GDB_TERM_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        gdb.kill()
+        gdb.wait()
+
+def gdb_lines(gdb):
+    """
+    returns a queue fed with the output lines of gdb, and None once it exits,
+    so that the output can be read with a timeout
+    """
+    lines = queue.Queue()
+    def read_lines():
+        for line in gdb.stdout:
+            lines.put(line)
+        lines.put(None)
+    Thread(target=read_lines, daemon=True).start()
+    return lines
+
+def fold_stack(frames, root=None):
+    """
+    folds a stack, innermost frame first, in the outermost;...;innermost
+    format used by flame graphs
+    """
+    frames = [frame.replace(";", ":") for frame in reversed(frames)]
+    if root:
+        frames.insert(0, root.replace(";", ":"))
+    return ";".join(frames)
+
+def read_proc_state(pid):
+    """
+    returns the scheduling state of a process from /proc: its 'state', the
+    'cpu_ticks' used so far, the kernel function it sleeps in ('wchan') and
+    the number of the syscall it is blocked in ('syscall'), or None if the
+    process is not running on this host
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            # the command name may contain spaces, skip past it
+            fields = f.read().rsplit(")", 1)[1].split()
+        state = {
+            'state': fields[0],
+            'cpu_ticks': int(fields[11]) + int(fields[12]),
+        }
+    except (OSError, IndexError, ValueError):
+        return None
+    # syscall is only readable by the owner of the process, or root
+    for name in ("wchan", "syscall"):
+        try:
+            with open("/proc/{}/{}".format(pid, name)) as f:
+                value = f.read().split()
+            state[name] = value[0] if value else None
+        except OSError:
+            state[name] = None
+    # a wchan of 0 means the process does not sleep in the kernel, while a
+    # syscall of 0 is a valid one (read() on x86_64)
+    if state['wchan'] == "0":
+        state['wchan'] = None
+    # -1 means the process is blocked, but not in a syscall
+    if state['syscall'] == "-1":
+        state['syscall'] = None
+    return state
+
+def gdb_string(output):
+    """
+    returns the string of the first value printed by gdb in output,
+    unescaped, or None
+    """
+    value = GDB_VALUE_RE.search(output)
+    if not value:
+        return None
+    match = GDB_STRING_RE.search(output, value.end())
+    if not match:
+        return None
+    try:
+        return codecs.decode(match.group(1).encode("latin-1",
+            errors="backslashreplace"), "unicode_escape")
+    except UnicodeDecodeError:
+        return match.group(1)
+
+def find_process_pids(name):
+    """
+    returns the pids of the processes running with the name, like pidof
+    """
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/comm".format(entry)) as f:
+                comm = f.read().rstrip("\n")
+        except OSError:
+            continue
+        # the kernel truncates the name of the process to 15 characters
+        if comm == name[:15]:
+            pids.append(entry)
+    return sorted(pids, key=int)
+
+def read_proc_info(pids):
+    """
+    returns, for each of the pids, a description of the process with its
+    user, parent, start time, threads and command line, read from /proc
+    """
+    try:
+        with open("/proc/stat") as f:
+            boot = next(int(line.split()[1]) for line in f
+                    if line.startswith("btime "))
+        clk_tck = os.sysconf('SC_CLK_TCK')
+    except (OSError, StopIteration, ValueError):
+        boot = None
+    users = {}
+    info = {}
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                # the command name may contain spaces, skip past it
+                fields = f.read().rsplit(")", 1)[1].split()
+            status = {}
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    status[name] = value.split()
+            with open("/proc/{}/cmdline".format(pid), "rb") as f:
+                cmdline = f.read().rstrip(b"\0").replace(b"\0", b" ").decode(
+                        errors="replace")
+        except (OSError, IndexError):
+            info[pid] = "UNKNOWN"
+            continue
+        uid = int(status['Uid'][0])
+        if uid not in users:
+            try:
+                users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                users[uid] = str(uid)
+        if boot is not None:
+            start = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(
+                boot + int(fields[19]) / clk_tck))
+        else:
+            start = "??"
+        info[pid] = "user={} ppid={} started={} threads={} cmd={}".format(
+                users[uid], fields[1], start, status['Threads'][0], cmdline)
+    return info
+
+class GdbSampler:
+    """
+    a persistent gdb, that backtraces on demand processes of the same binary,
+    without loading its symbols again for every backtrace
+    """
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timeout = timeout
+        self.gdb = None
+
+    def start(self):
+        self.gdb = subprocess.Popen(["gdb", "-q", "-nx", self.process],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True, errors="replace")
+        self.lines = gdb_lines(self.gdb)
+        self.gdb.stdin.write("set pagination off\nset confirm off\n"
+                "set width 0\n")
+
+    def backtrace(self, pid):
+        """
+        returns the backtrace of pid, or None if it could not be taken in
+        timeout seconds, in which case gdb is restarted for the next one
+        """
+        try:
+            if self.gdb is None:
+                self.start()
+            self.gdb.stdin.write("attach {}\nbt\ndetach\necho \\n{}end\\n\n".
+                    format(pid, GDB_PID_MARKER))
+            self.gdb.stdin.flush()
+        except OSError as e:
+            logger.error("could not run gdb: {}".format(e))
+            self.stop(force=True)
+            return None
+        output = []
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                line = self.lines.get(
+                        timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                logger.warning("gdb did not complete in {} seconds "
+                        "for pid {}".format(self.timeout, pid))
+                self.stop(force=True)
+                return None
+            if line is None:
+                self.stop(force=True)
+                return None
+            line = GDB_PROMPT_RE.sub("", line)
+            if line.strip() == GDB_PID_MARKER + "end":
+                return "".join(output)
+            output.append(line)
+
+    def stop(self, force=False):
+        if self.gdb is None:
+            return
+        if force:
+            stop_gdb(self.gdb)
+        else:
+            try:
+                # gdb quits at the end of its input
+                self.gdb.stdin.close()
+                self.gdb.wait(timeout=GDB_TERM_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                stop_gdb(self.gdb)
+        self.gdb = None
+
+def backtrace_frames(output):
+    """
+    normalizes a gdb backtrace to the list of its functions, innermost first
+    """
+    frames = []
+    for line in output.splitlines():
+        match = GDB_FRAME_RE.match(line)
+        if match:
+            frames.append(match.group(1))
+    return frames
+
+def backtrace_summary(backtraces):
+    """
+    groups the pids of the (pid, frames) backtraces by identical stacks;
+    returns the lines of the summary, most common stacks first
+    """
+    stacks = {}
+    for pid, frames in backtraces:
+        stacks.setdefault(tuple(frames), []).append(pid)
+    summary = []
+    for frames, pids in sorted(stacks.items(),
+            key=lambda stack: len(stack[1]), reverse=True):
+        if not frames:
+            stack = "unknown stack"
+        else:
+            stack = " <- ".join(frames[:TRAP_SUMMARY_DEPTH])
+            if len(frames) > TRAP_SUMMARY_DEPTH:
+                stack += " <- ..."
+        summary.append("{} process{} in {}: {}".format(len(pids),
+            "es" if len(pids) != 1 else "", stack, ", ".join(pids)))
+    return summary
+
 class trap(Module):
 
     def get_process_name(self):
@@ -44,38 +336,172 @@ class trap(Module):
                 format(pid['ID'], pid['PID'], pid['Type'])
                 for pid in mi_pids['Processes']]
             self.process_info = "\n".join(info)
+            self.types = {str(pid['PID']): pid['Type']
+                    for pid in mi_pids['Processes']}
         except:
             self.pids = []
 
-    def get_gdb_output(self, pid):
-        if os.path.islink("/proc/{}/exe".format(pid)):
+    def get_process_binary(self, pid):
+        try:
             # get process line of pid
             process = os.readlink("/proc/{}/exe".format(pid))
-        else:
+        except OSError:
             logger.error("could not find OpenSIPS process {} running on local machine".format(pid))
-            return -1
-        # Check if process is opensips (can be different if CLI is running on another host)
-        path, filename = os.path.split(process)
-        process_name = self.get_process_name()
-        if filename != process_name:
-            logger.error("process ID {}/{} is not OpenSIPS process".format(pid, filename))
-            return -1
+            return None
+        # Check if process is opensips (can be different if CLI is running on
+        # another host) - only once for each binary
+        if process not in self.binaries:
+            path, filename = os.path.split(process)
+            self.binaries[process] = filename == self.get_process_name()
+            if not self.binaries[process]:
+                logger.error("process ID {}/{} is not OpenSIPS process".format(pid, filename))
+        if not self.binaries[process]:
+            return None
+        return process
+
+    def get_gdb_output(self, pid, timeout):
+        process = self.get_process_binary(pid)
+        if process is None:
+            return None
         logger.debug("Dumping backtrace for {} pid {}".format(process, pid))
         cmd = ["gdb", process, pid, "-batch", "--eval-command", "bt full"]
-        out = subprocess.check_output(cmd)
-        if len(out) != 0:
-            self.gdb_outputs[pid] = out.decode()
+        return self.run_gdb(cmd, timeout)
 
-    def do_trap(self, params, modifiers):
+    def run_gdb(self, cmd, timeout):
+        """
+        runs gdb and returns its output, or None if it does not complete
+        within timeout seconds, in which case gdb is killed
+        """
+        try:
+            gdb = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        except OSError as e:
+            logger.error("could not run gdb: {}".format(e))
+            return None
+        try:
+            out, _ = gdb.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("gdb did not complete in {} seconds: {}".format(
+                timeout, " ".join(cmd)))
+            stop_gdb(gdb)
+            return None
+        return out.decode(errors="replace")
 
-        self.pids = []
-        self.gdb_outputs = {}
-        self.process_info = ""
+    def gdb_session_cmd(self, process, pids):
+        """
+        a single gdb loads the symbols of the binary once, then attaches to
+        each process in turn; the commands are passed with -ex rather than
+        through a script, since gdb aborts a script on the first failure
+        """
+        cmd = ["gdb", process, "-batch",
+                "-ex", "set pagination off", "-ex", "set confirm off"]
+        for pid in pids:
+            cmd += ["-ex", "echo \\n{}{}\\n".format(GDB_PID_MARKER, pid),
+                    "-ex", "attach {}".format(pid),
+                    "-ex", "bt full",
+                    "-ex", "detach"]
+        cmd += ["-ex", "echo \\n{}end\\n".format(GDB_PID_MARKER)]
+        return cmd
 
-        trap_file = cfg.get("trap_file")
-        process_name = self.get_process_name()
+    def gdb_session(self, process, pids, timeout):
+        """
+        backtraces all the pids of a binary through a single gdb session;
+        yields each (pid, output) as soon as it completes, or (pid, None) if
+        it could not be backtraced -- if gdb hangs on a process for more than
+        timeout seconds, it is killed, and a new session continues with the
+        rest of the processes
+        """
+        pending = list(pids)
+        while pending:
+            cmd = self.gdb_session_cmd(process, pending)
+            try:
+                gdb = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                        universal_newlines=True, errors="replace")
+            except OSError as e:
+                logger.error("could not run gdb: {}".format(e))
+                break
+
+            lines = gdb_lines(gdb)
+
+            try:
+                current = None
+                output = []
+                deadline = time.monotonic() + timeout
+                while True:
+                    try:
+                        line = lines.get(
+                                timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        logger.warning("gdb did not complete in {} seconds "
+                                "for pid {}".format(timeout, current))
+                        stop_gdb(gdb)
+                        if current is None:
+                            # stuck before even getting to the processes
+                            for pid in pending:
+                                yield pid, None
+                            return
+                        yield current, None
+                        pending.remove(current)
+                        break
+                    if line is None:
+                        # gdb exited, maybe before getting to all the processes
+                        gdb.wait()
+                        if current is not None:
+                            yield current, "".join(output)
+                            pending.remove(current)
+                        for pid in pending:
+                            yield pid, None
+                        return
+                    match = GDB_PID_MARKER_RE.match(line.strip())
+                    if not match:
+                        output.append(line)
+                        continue
+                    if current is not None:
+                        yield current, "".join(output)
+                        pending.remove(current)
+                    current = match.group(1) if match.group(1) != "end" else None
+                    output = []
+                    deadline = time.monotonic() + timeout
+            finally:
+                if gdb.poll() is None:
+                    stop_gdb(gdb)
+
+    def gdb_outputs(self, jobs, timeout):
+        """
+        backtraces each pid with its own gdb, with a bounded number of gdb
+        processes running in parallel; yields each (pid, output) completed
+        """
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            futures = {pool.submit(self.get_gdb_output, pid, timeout): pid
+                    for pid in self.pids}
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                # do not start any new gdb, the running ones are bounded
+                for future in futures:
+                    future.cancel()
 
-        logger.info("Trapping {} in {}".format(process_name, trap_file))
+    def single_gdb_outputs(self, timeout):
+        """
+        backtraces the pids with a single gdb session for each binary
+        """
+        binaries = {}
+        for pid in self.pids:
+            process = self.get_process_binary(pid)
+            if process is None:
+                yield pid, None
+                continue
+            binaries.setdefault(process, []).append(pid)
+        for process, pids in binaries.items():
+            logger.debug("Dumping backtraces for {} pids {}".format(
+                process, ", ".join(pids)))
+            yield from self.gdb_session(process, pids, timeout)
+
+    def find_pids(self, params):
+        """
+        uses the pids in params, or fetches them through MI, falling back
+        to the pids of the processes running with the OpenSIPS name
+        """
         if params and len(params) > 0:
             self.pids = params
         else:
@@ -84,52 +510,382 @@ class trap(Module):
             thread.join(timeout=1)
             if len(self.pids) == 0:
                 logger.warning("could not get OpenSIPS pids through MI!")
-                try:
-                    ps_pids = subprocess.check_output(["pidof", process_name])
-                    self.pids = ps_pids.decode().split()
-                except:
+                self.pids = find_process_pids(self.get_process_name())
+                if len(self.pids) == 0:
                     logger.warning("could not find any OpenSIPS running!")
-                    self.pids = []
 
         if len(self.pids) < 1:
             logger.error("could not find OpenSIPS' pids")
+            return False
+        return True
+
+    def trap_sample(self, opts, timeout, trap_file):
+        """
+        samples the stacks of the processes every interval, and writes the
+        counts of each stack, folded for flame graphs
+        """
+        try:
+            samples = int(opts['--sample'])
+            interval = float(opts.get('--interval',
+                cfg.get("trap_sample_interval"))) / 1000
+        except ValueError as e:
+            logger.error("invalid trap options: {}".format(e))
             return -1
 
-        logger.debug("Dumping PIDs: {}".format(", ".join(self.pids)))
+        samplers = {}
+        pids = {}
+        for pid in self.pids:
+            process = self.get_process_binary(pid)
+            if process is None:
+                continue
+            if process not in samplers:
+                samplers[process] = GdbSampler(process, timeout)
+            pids[pid] = samplers[process]
+        if len(pids) == 0:
+            logger.error("could not find any OpenSIPS process to sample")
+            return -1
+
+        logger.info("Sampling {} processes {} times, every {}ms".format(
+            len(pids), samples, int(interval * 1000)))
+        stacks = Counter()
+        taken = 0
+        try:
+            for _ in range(samples):
+                start = time.monotonic()
+                for pid, sampler in list(pids.items()):
+                    output = sampler.backtrace(pid)
+                    if output is None:
+                        # do not stall every sample on a stuck process
+                        logger.warning("not sampling pid {} anymore".format(pid))
+                        del pids[pid]
+                        continue
+                    frames = backtrace_frames(output)
+                    if not frames:
+                        continue
+                    stacks[fold_stack(frames, self.types.get(pid))] += 1
+                    taken += 1
+                if len(pids) == 0:
+                    break
+                time.sleep(max(0, interval - (time.monotonic() - start)))
+        except KeyboardInterrupt:
+            logger.warning("sampling interrupted, writing the samples taken")
+        finally:
+            for sampler in samplers.values():
+                sampler.stop()
+
+        if taken == 0:
+            logger.error("could not get output of gdb")
+            return -1
+
+        sample_file = "{}.folded".format(trap_file)
+        with open(sample_file, "w") as sf:
+            for stack, count in stacks.most_common():
+                sf.write("{} {}\n".format(stack, count))
+        logger.info("{} samples, {} distinct stacks".format(taken, len(stacks)))
+        print("Samples file: {}".format(sample_file))
+
+    def get_loads(self):
+        """
+        returns the realtime load of each OpenSIPS pid, fetched through MI
+        """
+        try:
+            mi_pids = comm.execute('ps')
+            load = comm.execute('get_statistics', {'statistics': ['load:']})
+            return {str(proc['PID']):
+                    int(load['load:load-proc-{}'.format(proc['ID'])])
+                    for proc in mi_pids['Processes']}
+        except:
+            return {}
+
+    def trap_watch(self, opts):
+        """
+        samples the state of the processes from /proc, without stopping
+        them, and returns the pids of the workers that look stuck
+        """
+        try:
+            duration = float(opts.get('--duration',
+                cfg.get("trap_watch_duration")))
+            interval = float(opts.get('--interval',
+                cfg.get("trap_sample_interval"))) / 1000
+        except ValueError as e:
+            logger.error("invalid trap options: {}".format(e))
+            return None
+
+        logger.info("Watching {} processes for {}s".format(
+            len(self.pids), duration))
+        loads = self.get_loads()
+        first = {}
+        last = {}
+        syscalls = {}
+        states = {}
+        deadline = time.monotonic() + duration
+        while True:
+            for pid in self.pids:
+                state = read_proc_state(pid)
+                if state is None:
+                    continue
+                first.setdefault(pid, state)
+                last[pid] = state
+                syscalls.setdefault(pid, set()).add(state['syscall'])
+                states.setdefault(pid, set()).add(state['state'])
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(min(interval, max(0, deadline - time.monotonic())))
+        # the load at the end of the watch
+        end_loads = self.get_loads()
+        if len(last) == 0:
+            logger.error("could not find any OpenSIPS process running on "
+                    "local machine")
+            return None
 
-        threads = []
+        stuck = []
+        print("{:>8} {:<24} {:>5} {:>5} {:>5} {:>8}  {}".format("PID", "Type",
+            "Load", "State", "CPU", "Syscall", "Wchan"))
         for pid in self.pids:
-            thread = Thread(target=self.get_gdb_output, args=(pid,))
-            thread.start()
-            threads.append(thread)
+            if pid not in last:
+                continue
+            cpu = last[pid]['cpu_ticks'] - first[pid]['cpu_ticks']
+            syscall = last[pid]['syscall']
+            same_syscall = len(syscalls[pid]) == 1 and \
+                    syscall not in (None, "running")
+            load = min(loads.get(pid, -1), end_loads.get(pid, -1))
+            if load < 0:
+                # no load through MI, rely on uninterruptible sleeps only
+                busy = states[pid] == {'D'}
+                load = "??"
+            else:
+                busy = load >= WATCH_STUCK_LOAD
+            flag = ""
+            if busy and (same_syscall or cpu == 0):
+                stuck.append(pid)
+                flag = "  <- STUCK"
+            print("{:>8} {:<24} {:>5} {:>5} {:>5} {:>8}  {}{}".format(pid,
+                self.types.get(pid, "")[:24], load, last[pid]['state'], cpu,
+                syscall or "-", last[pid]['wchan'] or "-", flag))
+        print()
+        if stuck:
+            print("{} stuck process{}: {}".format(len(stuck),
+                "es" if len(stuck) != 1 else "", ", ".join(stuck)))
+        else:
+            print("No stuck process found")
+        return stuck
+
+    def get_core_output(self, binary, core, timeout):
+        """
+        analyzes a core with gdb; returns the type of the process that
+        dumped it, the SIP message it was processing (both only available if
+        the binary has symbols) and the backtrace, or None on failure
+        """
+        commands = {
+            "type": ["print pt[process_no].desc"],
+            # the frame command fails if receive_msg is not on the stack
+            "message": ["frame function receive_msg", "print buf"],
+            "backtrace": ["bt full"],
+        }
+        cmd = ["gdb", binary, core, "-batch", "-ex", "set pagination off",
+                "-ex", "set print elements 0"]
+        for name, section in commands.items():
+            cmd += ["-ex", "echo \\n{}{}\\n".format(GDB_CORE_MARKER, name)]
+            for command in section:
+                cmd += ["-ex", command]
+        output = self.run_gdb(cmd, timeout)
+        if output is None:
+            return None
+
+        sections = {}
+        current = None
+        for line in output.splitlines(keepends=True):
+            match = GDB_CORE_MARKER_RE.match(line.strip())
+            if match:
+                current = match.group(1)
+                sections[current] = ""
+            elif current:
+                sections[current] += line
+        if not backtrace_frames(sections.get("backtrace", "")):
+            logger.warning("could not get the backtrace of core {}".format(core))
+            return None
+
+        message = sections.get("message", "")
+        if "receive_msg" not in backtrace_frames(message):
+            message = None
+        else:
+            message = gdb_string(message)
+        return gdb_string(sections.get("type", "")), message, \
+                sections["backtrace"]
 
-        for thread in threads:
-            thread.join()
+    def trap_core(self, params, jobs, timeout, trap_file, compress):
+        """
+        analyzes a core, or all the cores in a directory, in parallel, and
+        writes them in a trap file
+        """
+        if len(params) < 1:
+            logger.error("no core file specified")
+            return -1
+        if len(params) > 1:
+            binary = params[1]
+        else:
+            binary = shutil.which(self.get_process_name())
+            if binary is None:
+                logger.error("could not find the {} binary, please specify "
+                        "it".format(self.get_process_name()))
+                return -1
 
-        if len(self.gdb_outputs) == 0:
+        if os.path.isdir(params[0]):
+            cores = sorted(os.path.join(params[0], name)
+                    for name in os.listdir(params[0]) if "core" in name and
+                    os.path.isfile(os.path.join(params[0], name)))
+        else:
+            cores = [params[0]]
+        if len(cores) == 0:
+            logger.error("could not find any core in {}".format(params[0]))
+            return -1
+
+        logger.info("Analyzing {} cores of {} in {}".format(len(cores),
+            binary, trap_file))
+        # the cores are the "processes" of the trap
+        self.pids = cores
+        stacks = []
+        with open(trap_file, "w") as tf, \
+                ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            tf.write(self.process_info)
+            futures = {pool.submit(self.get_core_output, binary, core,
+                timeout): core for core in cores}
+            try:
+                for future in as_completed(futures):
+                    core = futures[future]
+                    result = future.result()
+                    if result is None:
+                        continue
+                    ptype, message, output = result
+                    section = "\n\n---start {} (binary={} type={})\n".format(
+                            core, binary, ptype or "UNKNOWN")
+                    if message is not None:
+                        section += "---message\n{}\n---backtrace\n".format(
+                                message)
+                    section += output
+                    tf.write(section)
+                    tf.flush()
+                    stacks.append((core, backtrace_frames(output)))
+            except KeyboardInterrupt:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        if len(stacks) == 0:
             logger.error("could not get output of gdb")
             return -1
 
+        trap_file = self.write_trap(trap_file, stacks, compress)
+        print("Trap file: {}".format(trap_file))
+
+    def do_trap(self, params, modifiers):
+
+        self.pids = []
+        self.types = {}
+        self.binaries = {}
+        self.process_info = ""
+
+        try:
+            opts, params = self.parse_options(
+                    (modifiers or []) + (params or []), TRAP_OPTIONS)
+            jobs = int(opts.get('--jobs', cfg.get("trap_jobs")))
+            timeout = int(opts.get('--timeout', cfg.get("trap_timeout")))
+        except ValueError as e:
+            logger.error("invalid trap options: {}".format(e))
+            return -1
+
+        trap_file = cfg.get("trap_file")
+        process_name = self.get_process_name()
+        compress = '--compress' in opts or cfg.getBool("trap_compress")
+
+        if params and params[0] == "core":
+            return self.trap_core(params[1:], jobs, timeout, trap_file,
+                    compress)
+
+        if params and params[0] == "watch":
+            if not self.find_pids(params[1:]):
+                return -1
+            stuck = self.trap_watch(opts)
+            if stuck is None:
+                return -1
+            if not stuck or '--gdb' not in opts:
+                return
+            # only trap the stuck processes
+            self.pids = stuck
+        else:
+            logger.info("Trapping {} in {}".format(process_name, trap_file))
+            if not self.find_pids(params):
+                return -1
+
+        if '--sample' in opts:
+            return self.trap_sample(opts, timeout, trap_file)
+
+        logger.debug("Dumping PIDs: {}".format(", ".join(self.pids)))
+
+        procinfo = read_proc_info(self.pids)
+
+        # each backtrace is written to the trap file as soon as it completes,
+        # only its frames are kept for the summary
+        stacks = []
         with open(trap_file, "w") as tf:
             tf.write(self.process_info)
-            for pid in self.pids:
-                if pid not in self.gdb_outputs:
+            tf.flush()
+            if '--single-gdb' in opts or cfg.getBool("trap_single_gdb"):
+                outputs = self.single_gdb_outputs(timeout)
+            else:
+                outputs = self.gdb_outputs(jobs, timeout)
+            for pid, output in outputs:
+                if not output:
                     logger.warning("No output from pid {}".format(pid))
                     continue
-                try:
-                    procinfo = subprocess.check_output(
-                        ["ps", "--no-headers", "-ww", "-fp", pid]).decode()[:-1]
-                except:
-                    procinfo = "UNKNOWN"
+                section = "\n\n---start {} ({})\n{}".format(
+                        pid, procinfo[pid], output)
+                tf.write(section)
+                tf.flush()
+                stacks.append((pid, backtrace_frames(output)))
 
-                tf.write("\n\n---start {} ({})\n{}".
-                        format(pid, procinfo, self.gdb_outputs[pid]))
+        if len(stacks) == 0:
+            logger.error("could not get output of gdb")
+            return -1
 
+        trap_file = self.write_trap(trap_file, stacks, compress)
         print("Trap file: {}".format(trap_file))
 
+    def write_trap(self, trap_file, stacks, compress):
+        """
+        adds a summary of the processes grouped by identical stacks, before
+        the backtraces streamed to the trap file, optionally compressing it
+        """
+        # backtraces complete in any order, keep the order of the processes
+        order = {pid: index for index, pid in enumerate(self.pids)}
+        summary = backtrace_summary(sorted(stacks,
+            key=lambda stack: order[stack[0]]))
+        logger.info("{} processes trapped, {} distinct stacks".format(
+            len(stacks), len(summary)))
+        final_file = trap_file + (".gz" if compress else ".tmp")
+        with open(trap_file, "rb") as tf, \
+                (gzip.open if compress else open)(final_file, "wb") as ff:
+            header = self.process_info.encode()
+            ff.write(header)
+            ff.write("\n\n---summary\n{}".format("\n".join(summary)).encode())
+            # copy the streamed backtraces in blocks, after the summary
+            tf.seek(len(header))
+            shutil.copyfileobj(tf, ff)
+        if compress:
+            os.remove(trap_file)
+            return final_file
+        os.replace(final_file, trap_file)
+        return trap_file
+
     def __get_methods__(self):
         return None
 
+    def __get_modifiers__(self):
+        return list(TRAP_OPTIONS.keys())
+
+    def __get_value_modifiers__(self):
+        return [o for o, value in TRAP_OPTIONS.items() if value]
+
     def __exclude__(self):
         valid = comm.valid()
         if not valid[0]:
@@ -23,8 +23,14 @@ from opensipscli.config import cfg
 from opensipscli.db import (
         osdb, osdbError
 )
+from concurrent.futures import ProcessPoolExecutor
 
 import os
+import re
+import sys
+import csv
+import json
+import time
 import getpass
 import hashlib
 
@@ -39,6 +45,86 @@ USER_HA1_SHA256_COL = "ha1_sha256"
 USER_HA1_SHA512T256_COL = "ha1_sha512t256"
 USER_RPID_COL = "rpid"
 
+USER_BULK_OPTIONS = {
+    '--jobs': True,
+    '--chunk': True,
+    '--from': True,
+    '--where': True,
+}
+
+def get_ha1(user, domain, password):
+    string = "{}:{}:{}".format(user, domain, password)
+    return hashlib.md5(string.encode('utf-8')).hexdigest()
+
+def get_ha1b(user, domain, password):
+    string = "{}@{}:{}:{}".format(user, domain, domain, password)
+    return hashlib.md5(string.encode('utf-8')).hexdigest()
+
+def get_ha1_sha256(user, domain, password):
+    string = "{}:{}:{}".format(user, domain, password)
+    return hashlib.sha256(string.encode('utf-8')).hexdigest()
+
+def get_ha1_sha512t256(user, domain, password):
+    string = "{}:{}:{}".format(user, domain, password)
+    try:
+        o = hashlib.new("sha512-256")
+    except ValueError:
+        # SHA-512/256 is only available w/ OpenSSL 1.1.1 (Sep 2018) or
+        # newer, so let's just leave the field blank if we get an exception
+        return ""
+    o.update(string.encode('utf-8'))
+    return o.hexdigest()
+
+def get_password_columns(record):
+    """
+    returns the password columns of a (username, domain, password,
+    osips_ver, plain_text_pw) record; runs in the processes of a pool, for
+    bulk operations
+    """
+    username, domain, password, osips_ver, plain_text_pw = record
+    columns = {
+        USER_HA1_COL: get_ha1(username, domain, password),
+        USER_PASS_COL: password if plain_text_pw else "",
+    }
+    # only populate the 'ha1b' column on 3.1 or older OpenSIPS DBs
+    if osips_ver < '3.2':
+        columns[USER_HA1B_COL] = get_ha1b(username, domain, password)
+    else:
+        columns[USER_HA1_SHA256_COL] = \
+                get_ha1_sha256(username, domain, password)
+        columns[USER_HA1_SHA512T256_COL] = \
+                get_ha1_sha512t256(username, domain, password)
+    return columns
+
+def read_users(path):
+    """
+    streams the users of a CSV file, with a header naming its columns, or of
+    a NDJSON file, one JSON object per line; yields (line, record) for each
+    """
+    with open(path, newline="") as f:
+        if os.path.splitext(path)[1].lower() in (".json", ".ndjson", ".jsonl"):
+            for line, entry in enumerate(f, 1):
+                if not entry.strip():
+                    continue
+                try:
+                    yield line, json.loads(entry)
+                except ValueError:
+                    yield line, None
+        else:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 class user(Module):
 
     def user_db_connect(self):
@@ -103,33 +189,54 @@ class user(Module):
                 return pw1
 
     def user_get_ha1(self, user, domain, password):
-        string = "{}:{}:{}".format(user, domain, password)
-        return hashlib.md5(string.encode('utf-8')).hexdigest()
+        return get_ha1(user, domain, password)
 
     def user_get_ha1b(self, user, domain, password):
-        string = "{}@{}:{}:{}".format(user, domain, domain, password)
-        return hashlib.md5(string.encode('utf-8')).hexdigest()
+        return get_ha1b(user, domain, password)
 
     def user_get_ha1_sha256(self, user, domain, password):
-        string = "{}:{}:{}".format(user, domain, password)
-        return hashlib.sha256(string.encode('utf-8')).hexdigest()
+        return get_ha1_sha256(user, domain, password)
 
-    def user_get_ha1_sha512t256(self, user, domain, password):
-        string = "{}:{}:{}".format(user, domain, password)
+    def user_check_sha512t256(self):
         try:
-            o = hashlib.new("sha512-256")
+            hashlib.new("sha512-256")
         except ValueError:
-            # SHA-512/256 is only available w/ OpenSSL 1.1.1 (Sep 2018) or
-            # newer, so let's just leave the field blank if we get an exception
             logger.error(("The SHA-512/256 hashing algorithm is "
                             "apparently not available!?"))
             logger.error("Adding user, but with a blank '{}' column!".format(
                     USER_HA1_SHA512T256_COL))
             logger.error("Tip: installing OpenSSL 1.1.1+ should fix this")
-            return ""
+            return False
+        return True
 
-        o.update(string.encode('utf-8'))
-        return o.hexdigest()
+    def user_get_ha1_sha512t256(self, user, domain, password):
+        self.user_check_sha512t256()
+        return get_ha1_sha512t256(user, domain, password)
+
+    def user_bulk_options(self, params, modifiers):
+        """
+        parses the options of the bulk commands; returns the options, with
+        the number of processes computing the digests and the number of
+        users in each transaction, and the rest of the params
+        """
+        opts, params = self.parse_options(
+                (modifiers or []) + (params or []), USER_BULK_OPTIONS)
+        # the digests are computed in as many processes as CPUs, by default
+        opts['--jobs'] = int(opts['--jobs']) if '--jobs' in opts else None
+        opts['--chunk'] = int(opts.get('--chunk', cfg.get("user_chunk_size")))
+        if opts['--chunk'] < 1 or (opts['--jobs'] is not None and
+                opts['--jobs'] < 1):
+            raise ValueError("--jobs and --chunk must be positive")
+        return opts, params
+
+    def user_progress(self, action, done, skipped, start, final=False):
+        elapsed = max(time.time() - start, 0.001)
+        line = "{} {} users, {} skipped ({:.0f} users/s)".format(
+                action, done, skipped, done / elapsed)
+        if final:
+            print(line)
+        elif sys.stdout.isatty():
+            print(line, end="\r", flush=True)
 
     def do_add(self, params=None, modifiers=None):
 
@@ -187,8 +294,250 @@ class user(Module):
         db.destroy()
         return True
 
+    def user_bulk_chunks(self, path, size, with_password=True):
+        """
+        streams the users of a file in chunks; yields, for each chunk, a
+        dict with the (username, domain) of its users, mapped to their
+        password, and the number of invalid or duplicate records skipped
+        """
+        default_domain = None
+        for chunk in chunks(read_users(path), size):
+            users = {}
+            skipped = 0
+            for line, record in chunk:
+                if not record or not record.get(USER_NAME_COL) or \
+                        (with_password and record.get(USER_PASS_COL) is None):
+                    logger.warning("{}:{}: invalid user record".
+                            format(path, line))
+                    skipped += 1
+                    continue
+                username = str(record[USER_NAME_COL])
+                domain = record.get(USER_DOMAIN_COL)
+                if not domain and '@' in username:
+                    username, domain = username.split('@', 1)
+                if not domain:
+                    if default_domain is None:
+                        default_domain = cfg.read_param("domain",
+                            "Please provide the domain of the users")
+                        if not default_domain:
+                            raise ValueError("no domain specified")
+                    domain = default_domain
+                if (username, domain) in users:
+                    skipped += 1
+                    continue
+                users[(username, domain)] = str(record.get(USER_PASS_COL))
+            yield users, skipped
+
+    def user_bulk_existing(self, db, users):
+        """
+        returns the users, out of the (username, domain) ones, that exist in
+        the database, with a single query
+        """
+        if not users:
+            return set()
+        keys = (USER_NAME_COL, USER_DOMAIN_COL)
+        existing = db.find_many(USER_TABLE, list(keys), keys,
+                [dict(zip(keys, user)) for user in users])
+        if existing is None:
+            raise osdbError("cannot check the existing users")
+        return set(tuple(user) for user in existing) & set(users)
+
+    def user_bulk_passwords(self, pool, users, osips_ver):
+        """
+        computes, in parallel, the password columns of the users, mapped to
+        their password; returns them as rows keyed by the users
+        """
+        plain_text_pw = cfg.getBool("plain_text_passwords")
+        records = [(username, domain, password, osips_ver, plain_text_pw)
+                for (username, domain), password in users.items()]
+        rows = []
+        for (username, domain), columns in zip(users, pool.map(
+                get_password_columns, records,
+                chunksize=max(len(records) // 64, 1))):
+            rows.append(({USER_NAME_COL: username, USER_DOMAIN_COL: domain},
+                columns))
+        return rows
+
+    def user_bulk_run(self, action, path, opts, run, with_password=True):
+        """
+        runs action over all the users of a file, a chunk at a time, through
+        a single connection; run(db, pool, osips_ver, users) applies it to
+        the users of a chunk, and returns how many of them it skipped
+        """
+        if not os.path.isfile(path):
+            logger.error("cannot find file {}".format(path))
+            return -1
+
+        db, osips_ver = self.user_db_connect()
+        if not db:
+            return -1
+        if with_password and osips_ver >= '3.2':
+            self.user_check_sha512t256()
+
+        done = 0
+        skipped = 0
+        start = time.time()
+        try:
+            with ProcessPoolExecutor(max_workers=opts['--jobs']) as pool:
+                for users, invalid in self.user_bulk_chunks(path,
+                        opts['--chunk'], with_password):
+                    total = len(users)
+                    missing = run(db, pool, osips_ver, users)
+                    done += total - missing
+                    skipped += invalid + missing
+                    self.user_progress(action, done, skipped, start)
+        except (osdbError, ValueError) as e:
+            logger.error("{}: aborting".format(e))
+            self.user_progress(action, done, skipped, start, True)
+            return -1
+        except (OSError, csv.Error) as e:
+            logger.error("cannot read users from {}: {}".format(path, e))
+            self.user_progress(action, done, skipped, start, True)
+            return -1
+        finally:
+            db.destroy()
+
+        self.user_progress(action, done, skipped, start, True)
+        return True
+
+    def user_bulk_request(self, params, modifiers):
+        """
+        checks if a command is applied in bulk, to the users of a file or
+        matching a filter
+        """
+        return any(token.partition("=")[0] in ('--from', '--where')
+                for token in (modifiers or []) + (params or []))
+
+    def do_import(self, params=None, modifiers=None):
+
+        try:
+            opts, params = self.user_bulk_options(params, modifiers)
+        except ValueError as e:
+            logger.error("invalid import options: {}".format(e))
+            return -1
+        if len(params) < 1:
+            logger.error("no file to import users from!")
+            return -1
+
+        def import_users(db, pool, osips_ver, users):
+            # already existing users are skipped
+            existing = self.user_bulk_existing(db, users)
+            for user in existing:
+                del users[user]
+            if not users:
+                return len(existing)
+            rows = [dict(keys, **columns) for keys, columns in
+                    self.user_bulk_passwords(pool, users, osips_ver)]
+            with db.transaction():
+                if not db.insert(USER_TABLE, rows):
+                    raise osdbError("cannot insert users")
+            return len(existing)
+
+        return self.user_bulk_run("Imported", params[0], opts, import_users)
+
+    def user_bulk_password(self, params, modifiers):
+
+        try:
+            opts, params = self.user_bulk_options(params, modifiers)
+        except ValueError as e:
+            logger.error("invalid password options: {}".format(e))
+            return -1
+        if '--from' not in opts:
+            logger.error("passwords can only be changed in bulk --from a file")
+            return -1
+
+        def change_passwords(db, pool, osips_ver, users):
+            existing = self.user_bulk_existing(db, users)
+            missing = len(users) - len(existing)
+            for user in set(users) - existing:
+                logger.warning("User {}@{} does not exist".format(*user))
+                del users[user]
+            if not users:
+                return missing
+            keys, columns = zip(*self.user_bulk_passwords(pool, users,
+                osips_ver))
+            with db.transaction():
+                if not db.update(USER_TABLE, list(columns), list(keys)):
+                    raise osdbError("cannot update users")
+            return missing
+
+        return self.user_bulk_run("Changed password for", opts['--from'],
+                opts, change_passwords)
+
+    def user_bulk_delete(self, params, modifiers):
+
+        try:
+            opts, params = self.user_bulk_options(params, modifiers)
+        except ValueError as e:
+            logger.error("invalid delete options: {}".format(e))
+            return -1
+
+        if '--where' in opts:
+            return self.user_delete_where(opts['--where'])
+        if '--from' not in opts:
+            logger.error("users can only be deleted in bulk --from a file "
+                    "or --where a filter matches")
+            return -1
+
+        def delete_users(db, pool, osips_ver, users):
+            existing = self.user_bulk_existing(db, users)
+            for user in set(users) - existing:
+                logger.warning("User {}@{} does not exist".format(*user))
+            if not existing:
+                return len(users)
+            keys = (USER_NAME_COL, USER_DOMAIN_COL)
+            with db.transaction():
+                if not db.delete(USER_TABLE,
+                        [dict(zip(keys, user)) for user in existing]):
+                    raise osdbError("cannot delete users")
+            return len(users) - len(existing)
+
+        return self.user_bulk_run("Deleted", opts['--from'], opts,
+                delete_users, False)
+
+    def user_delete_where(self, where):
+        """
+        deletes all the users matching a column=value[,column=value] filter
+        """
+        filter_keys = {}
+        for cond in where.split(","):
+            col, sep, value = cond.partition("=")
+            col = col.strip()
+            if not sep or not re.match(r"^\w+$", col):
+                logger.error("invalid filter '{}', expected column=value".
+                        format(cond))
+                return -1
+            filter_keys[col] = value.strip()
+
+        db, _ = self.user_db_connect()
+        if not db:
+            return -1
+        try:
+            res = db.find(USER_TABLE, "count(*)", filter_keys)
+            if not res:
+                return -1
+            count = res.first()[0]
+            if count == 0:
+                logger.warning("no user matches {}".format(where))
+                return -1
+            if not cfg.read_param("user_force_delete",
+                    "Do you really want to delete the {} users matching {}".
+                        format(count, where), False, True, isbool=True):
+                logger.info("users not deleted!")
+                return -1
+            # a single statement, committed at once
+            if not db.delete(USER_TABLE, filter_keys):
+                return -1
+            logger.info("Successfully deleted {} users".format(count))
+        finally:
+            db.destroy()
+        return True
+
     def do_password(self, params=None, modifiers=None):
 
+        if self.user_bulk_request(params, modifiers):
+            return self.user_bulk_password(params, modifiers)
+
         if len(params) < 1:
             name = cfg.read_param(None,
                     "Please provide the username to change the password for")
@@ -240,6 +589,9 @@ class user(Module):
 
     def do_delete(self, params=None, modifiers=None):
 
+        if self.user_bulk_request(params, modifiers):
+            return self.user_bulk_delete(params, modifiers)
+
         if len(params) < 1:
             name = cfg.read_param(None,
                     "Please provide the username you want to delete")
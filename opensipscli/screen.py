@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+screen.py - flicker-free rendering of full-screen, periodically refreshed views
+"""
+
+import io
+import os
+import re
+import select
+import shutil
+import sys
+import time
+from contextlib import contextmanager, redirect_stdout
+
+try:
+    import termios
+    import tty
+    have_termios = True
+except ImportError:
+    have_termios = False
+
+# the ANSI escape sequences (e.g. colors) take no room on the terminal
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+def crop_line(line, columns):
+    """
+    crops a line to the given number of visible columns, keeping whole all
+    the ANSI escape sequences, and resetting the attributes if any was cut
+    """
+    out = []
+    width = 0
+    pos = 0
+    for escape in ANSI_ESCAPE.finditer(line):
+        text = line[pos:escape.start()]
+        if width + len(text) > columns:
+            break
+        out.append(text)
+        out.append(escape.group())
+        width += len(text)
+        pos = escape.end()
+    else:
+        if width + len(line) - pos <= columns:
+            return line
+    out.append(line[pos:pos + columns - width])
+    if pos > 0:
+        out.append("\033[0m")
+    return "".join(out)
+
+class Screen(object):
+    """
+    Renders frames of text on the terminal: only the lines that changed since
+    the previous frame are redrawn, using ANSI cursor addressing, in a single
+    write; lines are cropped to the terminal width, while frames taller than
+    the terminal are printed as they are, scrolling
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.lines = []
+        self.size = None
+
+    @contextmanager
+    def frame(self):
+        """
+        everything printed within the context makes up the next frame
+        """
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            yield
+        self.render(buf.getvalue())
+
+    def render(self, text):
+        if text.endswith("\n"):
+            text = text[:-1]
+        lines = [line.expandtabs() for line in text.split("\n")]
+
+        if not self.stream.isatty():
+            # nothing to redraw in place, just dump the frame
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+            return
+
+        size = shutil.get_terminal_size()
+        if len(lines) > size.lines - 1:
+            # the tail would not be visible: let the terminal scroll, and
+            # redraw everything once the frame fits again
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+            self.size = None
+            self.lines = []
+            return
+        lines = [crop_line(line, size.columns) for line in lines]
+        out = []
+        if size != self.size:
+            # first frame, or the terminal was resized: redraw everything
+            out.append("\033[H\033[2J")
+            self.size = size
+            prev = []
+        else:
+            prev = self.lines
+        for i, line in enumerate(lines):
+            if i < len(prev) and prev[i] == line:
+                continue
+            out.append("\033[{};1H{}\033[K".format(i + 1, line))
+        if len(lines) < len(prev):
+            out.append("\033[{};1H\033[J".format(len(lines) + 1))
+        # park the cursor right below the frame
+        out.append("\033[{};1H".format(len(lines) + 1))
+        self.stream.write("".join(out))
+        self.stream.flush()
+        self.lines = lines
+
+class Keyboard(object):
+    """
+    Reads single key presses from a terminal, without waiting for Enter;
+    used as a context manager, that restores the terminal settings on exit
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdin
+        self.settings = None
+
+    def __enter__(self):
+        if have_termios and self.stream.isatty():
+            self.settings = termios.tcgetattr(self.stream)
+            tty.setcbreak(self.stream)
+        return self
+
+    def __exit__(self, *args):
+        if self.settings is not None:
+            termios.tcsetattr(self.stream, termios.TCSADRAIN, self.settings)
+            self.settings = None
+
+    def read(self, timeout):
+        """
+        waits up to timeout seconds for a key press; returns the key or None
+        """
+        if self.settings is None:
+            time.sleep(timeout)
+            return None
+        ready, _, _ = select.select([self.stream], [], [], timeout)
+        if not ready:
+            return None
+        return os.read(self.stream.fileno(), 1).decode(errors="ignore")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
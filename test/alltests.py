@@ -1,6 +1,57 @@
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import time
 import unittest
+from io import StringIO
+from unittest import mock
 
-from opensipscli.db import make_url
+from opensipscli.cli import OpenSIPSCLI
+from opensipscli.db import make_url, osdb
+from opensipscli.modules.user import user, get_ha1
+from opensipscli.screen import Screen
+from opensipscli.modules.diagnose import (
+        diagnose, JSONStreamDecoder, SpaceSaving, TopSlowest, SessionRecorder,
+        MemoryTrend, parse_iface, decode_proc_addr, ProcSampler,
+        advise_pool_size, advise_scale_out
+)
+from opensipscli.modules.trap import trap, backtrace_frames, \
+        backtrace_summary, fold_stack, read_proc_state, read_proc_info, \
+        find_process_pids, gdb_string
+from opensipscli.modules.trace import (
+        HEPmerger, HEPstream, SIPmessage, CallTracker, SIPstats,
+        compile_filters, TraceStore, build_query
+)
+
+def hep_chunk(type_id, payload):
+    return (0).to_bytes(2, "big") + type_id.to_bytes(2, "big") + \
+            (len(payload) + 6).to_bytes(2, "big") + payload
+
+def hep_packet(ts, tms=0, data=b"", src="10.0.0.1", dst="10.0.0.2",
+        sport=5060, dport=5060, proto=socket.IPPROTO_UDP, type_id=0x01,
+        correlation=None):
+    chunks = hep_chunk(0x0001, bytes([socket.AF_INET])) + \
+            hep_chunk(0x0002, bytes([proto])) + \
+            hep_chunk(0x0003, socket.inet_aton(src)) + \
+            hep_chunk(0x0004, socket.inet_aton(dst)) + \
+            hep_chunk(0x0007, sport.to_bytes(2, "big")) + \
+            hep_chunk(0x0008, dport.to_bytes(2, "big")) + \
+            hep_chunk(0x0009, ts.to_bytes(4, "big")) + \
+            hep_chunk(0x000a, tms.to_bytes(4, "big")) + \
+            hep_chunk(0x000b, bytes([type_id])) + \
+            hep_chunk(0x000f, data)
+    if correlation is not None:
+        chunks += hep_chunk(0x0011, correlation)
+    return b"HEP3" + (len(chunks) + 6).to_bytes(2, "big") + chunks
+
+def sip_msg(first_line, callid="c1", cseq="1 INVITE", branch="z9hG4bK1",
+        extra=""):
+    return ("{}\r\nVia: SIP/2.0/UDP 10.0.0.1;branch={}\r\n"
+            "From: <sip:alice@a.com>;tag=1\r\nTo: <sip:bob@b.com>\r\n"
+            "Call-ID: {}\r\nCSeq: {}\r\n{}Content-Length: 0\r\n\r\n".format(
+                first_line, branch, callid, cseq, extra)).encode()
 
 class OpenSIPSCLIUnitTests(unittest.TestCase):
     def testMakeURL(self):
@@ -38,6 +89,486 @@ class OpenSIPSCLIUnitTests(unittest.TestCase):
         assert repr(u) == 'mysql://root@localhost'
         assert str(u) == 'mysql://root@localhost'
 
+    def testHEPMerge(self):
+        out = []
+        merger = HEPmerger(out.append, 1, ["a", "b"])
+        a = HEPstream(None, "a")
+        b = HEPstream(None, "b")
+
+        raw = hep_packet(10, 5) + hep_packet(12)
+        # packets split across reads must be reassembled
+        self.assertEqual(a.feed(raw[:20]), [])
+        for p in a.feed(raw[20:]):
+            merger.push(p)
+        merger.flush()
+        # stream "b" did not speak yet, so nothing is released
+        self.assertEqual(out, [])
+
+        for p in b.feed(hep_packet(11) + hep_packet(20)):
+            merger.push(p)
+        merger.flush()
+        self.assertEqual([p.timestamp() for p in out],
+                [10000005, 11000000])
+
+        merger.flush(True)
+        self.assertEqual([(p.instance, p.timestamp()) for p in out],
+                [("a", 10000005), ("b", 11000000), ("a", 12000000),
+                 ("b", 20000000)])
+        self.assertIsNone(a.feed(b"HEP2" + raw[4:]))
+
+    def testSIPMessage(self):
+        msg = SIPmessage(b"INVITE sip:bob@b.com SIP/2.0\r\n"
+                b"v: SIP/2.0/UDP 10.0.0.1;branch=z9hG4bKa, SIP/2.0/UDP x\r\n"
+                b"f: Alice <sip:alice@a.com>;tag=1\r\n"
+                b"i: abc@host\r\nCSeq: 10 INVITE\r\n"
+                b"Subject: multi\r\n line\r\n\r\nCall-ID: body\r\n")
+        self.assertTrue(msg.is_request())
+        self.assertEqual(msg.callid(), "abc@host")
+        self.assertEqual(msg.cseq(), (10, "INVITE"))
+        self.assertEqual(msg.via_branch(), "z9hG4bKa")
+        self.assertEqual(msg.uri_user("from"), "alice")
+        self.assertEqual(msg.header("subject"), "multi\r\n line")
+        self.assertIsNone(msg.header("to"))
+
+        msg = SIPmessage(sip_msg("SIP/2.0 486 Busy Here"))
+        self.assertEqual((msg.code, msg.summary()),
+                (486, "486 Busy Here (INVITE)"))
+
+    def testCallTracker(self):
+        out = []
+        tracker = CallTracker(out.append, 30, 2)
+        stream = HEPstream(None)
+        for i, m in enumerate([sip_msg("INVITE sip:bob@b.com SIP/2.0"),
+                sip_msg("SIP/2.0 200 OK"),
+                sip_msg("OPTIONS sip:x SIP/2.0", "c2", "1 OPTIONS"),
+                sip_msg("BYE sip:bob@b.com SIP/2.0", cseq="2 BYE"),
+                sip_msg("SIP/2.0 200 OK", cseq="2 BYE")]):
+            for p in stream.feed(hep_packet(100 + i, data=m)):
+                tracker.push(p)
+        tracker.flush()
+        self.assertEqual(out, [])
+        self.assertEqual(tracker.ended, {"c1"})
+
+        # a third call evicts the least recently used one
+        for p in stream.feed(hep_packet(200, data=sip_msg(
+                "MESSAGE sip:x SIP/2.0", "c3", "1 MESSAGE"))):
+            tracker.push(p)
+        self.assertEqual(len(out), 1)
+        self.assertIn("Call-ID: c2 OPTIONS alice -> bob (1 messages", out[0])
+        self.assertIn("evicted", out[0])
+
+        tracker.flush(True)
+        self.assertIn("Call-ID: c1 INVITE alice -> bob (4 messages, "
+                "4.000s, completed)", out[1])
+        self.assertIn("10.0.0.1:5060 -> 10.0.0.2:5060 200 OK (BYE)", out[1])
+        self.assertEqual(tracker.calls, {})
+
+    def testSIPStats(self):
+        stats = SIPstats(None)
+        stream = HEPstream(None)
+        for ts, tms, m in [
+                (100, 0, sip_msg("INVITE sip:bob@b.com SIP/2.0")),
+                (100, 500, sip_msg("INVITE sip:bob@b.com SIP/2.0")),
+                (100, 3000, sip_msg("SIP/2.0 100 Trying")),
+                (101, 0, sip_msg("SIP/2.0 200 OK")),
+                (101, 0, sip_msg("ACK sip:bob@b.com SIP/2.0", cseq="1 ACK")),
+                (102, 0, sip_msg("OPTIONS sip:x SIP/2.0", "c2", "1 OPTIONS",
+                    "z9hG4bK2")),
+                (140, 0, sip_msg("SIP/2.0 404 Not Found", "c2", "1 OPTIONS",
+                    "z9hG4bK3"))]:
+            for p in stream.feed(hep_packet(ts, tms, data=m)):
+                stats.push(p)
+
+        invite = stats.methods["INVITE"]
+        self.assertEqual(invite.requests, 2)
+        self.assertEqual(invite.replies, [1, 1, 0, 0, 0, 0])
+        self.assertEqual(invite.first_reply.percentile(50), "<5")
+        self.assertEqual(invite.final_reply.percentile(90), "<1000")
+        self.assertEqual(stats.methods["OPTIONS"].final_reply.total, 0)
+        self.assertEqual(len(stats.transactions), 1)
+        stats.expire()
+        self.assertEqual((len(stats.transactions), stats.expired), (0, 1))
+
+    def testTraceFilters(self):
+        stream = HEPstream(None)
+        invite, busy, log = stream.feed(
+                hep_packet(1, data=sip_msg("INVITE sip:bob@b.com SIP/2.0",
+                    extra="User-Agent: Linphone/5.0\r\n")) +
+                hep_packet(2, src="10.1.2.3", proto=socket.IPPROTO_TCP,
+                    data=sip_msg("SIP/2.0 486 Busy Here")) +
+                hep_packet(3, type_id=0x56, data=b"log line"))
+
+        def matching(*filters):
+            match = compile_filters(filters)
+            return [p.ts for p in (invite, busy, log) if match(p)]
+
+        self.assertIsNone(compile_filters([]))
+        self.assertEqual(matching("method=invite"), [1, 2])
+        self.assertEqual(matching("code=4xx"), [2])
+        self.assertEqual(matching("code=100-199"), [])
+        self.assertEqual(matching("type=SIP,LOG", "src=10.1.0.0/16"), [2])
+        self.assertEqual(matching("transport=udp"), [1, 3])
+        self.assertEqual(matching("dst=10.0.0.2"), [1, 2, 3])
+        self.assertEqual(matching("header=user-agent:^Linphone"), [1])
+        for bad in ["type=FOO", "code=abc", "src=10.0.0", "header=x",
+                "method="]:
+            self.assertRaises(ValueError, compile_filters, [bad])
+
+    def testTraceStore(self):
+        path = os.path.join(tempfile.mkdtemp(), "trace.db")
+        store = TraceStore(path)
+        stream = HEPstream(None)
+        for i, (callid, src) in enumerate([("c1", "10.1.2.3"),
+                ("c2", "10.2.0.1"), ("c1", "10.0.0.9"), ("c3", "10.1.2.4")]):
+            for p in stream.feed(hep_packet(1000 + i * 60, src=src,
+                    data=sip_msg("INVITE sip:bob@b.com SIP/2.0", callid))):
+                store.push(p)
+        store.flush(True)
+
+        db = sqlite3.connect(path)
+        def run(filters, calls=False):
+            query, args = build_query(db, filters, calls)
+            return [row[0] for row in db.execute(query, args)]
+
+        self.assertEqual(run(["src=10.1.2.0/24"]),
+                [1000000000, 1180000000])
+        self.assertEqual(run(["src=10.1.2.0/24", "end=1100"], True),
+                [1000000000, 1120000000])
+        self.assertEqual(run(["caller=alice@a.com", "method=invite",
+                "code=2xx"]), [])
+        self.assertEqual(len(run(["callee=bob"])), 4)
+        self.assertRaises(ValueError, build_query, db, ["foo=bar"])
+        db.close()
+
+    def testOsdbStatements(self):
+        db = osdb("sqlite://", "opensips")
+        db._osdb__conn.exec_driver_sql("CREATE TABLE subscriber "
+                "(username TEXT, domain TEXT, ha1 TEXT)")
+        self.assertTrue(db.insert("subscriber",
+            {"username": "o'brien", "domain": "a.com", "ha1": "x"}))
+        self.assertEqual(db.insert("subscriber", [{"username": "u{}".format(i),
+            "domain": "b.com", "ha1": "x"} for i in range(3)]).rowcount, 3)
+        self.assertTrue(db.entry_exists("subscriber", {"username": "o'brien"}))
+        self.assertEqual(db.update("subscriber", [{"ha1": "y"}, {"ha1": "z"}],
+            [{"username": "u0"}, {"username": "u1"}]).rowcount, 2)
+        self.assertTrue(db.delete("subscriber", {"domain": "a.com"}))
+        self.assertEqual(db.find("subscriber", ["username", "ha1"],
+            {"domain": "b.com"}).fetchall(),
+            [("u0", "y"), ("u1", "z"), ("u2", "x")])
+        # the statements are built once for the same table and columns
+        statements = len(db._osdb__statements)
+        db.entry_exists("subscriber", {"username": "u2"})
+        self.assertEqual(len(db._osdb__statements), statements)
+        db.destroy()
+
+    def testUserImport(self):
+        tmp = tempfile.mkdtemp()
+        db_url = "sqlite:///" + os.path.join(tmp, "opensips.db")
+        db = osdb(db_url, "opensips")
+        db._osdb__conn.exec_driver_sql("CREATE TABLE subscriber (username "
+                "TEXT, domain TEXT, password TEXT, ha1 TEXT, ha1_sha256 TEXT, "
+                "ha1_sha512t256 TEXT, UNIQUE (username, domain))")
+        db.insert("subscriber", {"username": "u1", "domain": "a.com"})
+        path = os.path.join(tmp, "users.csv")
+        with open(path, "w") as f:
+            f.write("username,domain,password\nu0,a.com,p0\nu1,a.com,p1\n"
+                    "u2@b.com,,p2\nu0,a.com,p0\n,,\n")
+        with mock.patch.object(user, 'user_db_connect',
+                return_value=(osdb(db_url, "opensips"), '3.2+')), \
+                mock.patch('opensipscli.modules.user.logger'), \
+                mock.patch('sys.stdout', new=StringIO()):
+            self.assertTrue(user().do_import([path, "--chunk", "2",
+                "--jobs", "2"]))
+        self.assertEqual(db.find("subscriber", ["username", "domain", "ha1"],
+            None).fetchall(), [("u1", "a.com", None),
+                ("u0", "a.com", get_ha1("u0", "a.com", "p0")),
+                ("u2", "b.com", get_ha1("u2", "b.com", "p2"))])
+
+        # bulk password change, then deletion, of the same users
+        with open(path, "w") as f:
+            f.write("username,password\nu0@a.com,n0\nu2@b.com,n2\n")
+        with mock.patch.object(user, 'user_db_connect',
+                side_effect=lambda: (osdb(db_url, "opensips"), '3.2+')), \
+                mock.patch('opensipscli.modules.user.logger'), \
+                mock.patch('sys.stdout', new=StringIO()):
+            self.assertTrue(user().do_password(["--from", path]))
+            self.assertEqual(db.find("subscriber", "ha1",
+                {"username": "u2"}).first()[0], get_ha1("u2", "b.com", "n2"))
+            self.assertTrue(user().do_delete(["--from", path]))
+        self.assertEqual(db.find("subscriber", "username", None).fetchall(),
+                [("u1",)])
+        db.destroy()
+
+    def testJSONStreamDecoder(self):
+        stream = ('{"params": {"extra": "SELECT \\"}{\\" FROM t", "x": "\u0103"}}'
+                ' \n[1, {"a": []}]{"b": "\\\\"}').encode()
+        expected = [{"params": {"extra": 'SELECT "}{" FROM t', "x": "\u0103"}},
+                [1, {"a": []}], {"b": "\\"}]
+
+        # feed the stream in all possible 2-chunk splits, including
+        # splits inside multi-byte UTF-8 sequences and escapes
+        for i in range(len(stream)):
+            decoder = JSONStreamDecoder()
+            objs = decoder.feed(stream[:i]) + decoder.feed(stream[i:])
+            self.assertEqual(objs, expected)
+            self.assertEqual(decoder.text, "")
+
+        decoder = JSONStreamDecoder()
+        objs = []
+        for b in stream:
+            objs += decoder.feed(bytes([b]))
+        self.assertEqual(objs, expected)
+
+    def testThresholdSummaries(self):
+        summary = SpaceSaving(3)
+        for i in range(1000):
+            summary.add("hot")
+            summary.add("warm" if i % 2 else "query-{}".format(i))
+        self.assertEqual(len(summary), 3)
+        top = summary.top(2)
+        self.assertEqual(top[0], (1000, "hot"))
+        self.assertEqual(top[1][1], "warm")
+        # counts are over-estimated, never under-estimated
+        self.assertGreaterEqual(top[1][0], 500)
+
+        slowest = TopSlowest(3)
+        for t in [5, 1, 9, 7, 3, 9]:
+            slowest.add(t, "q{}".format(t), "mysql")
+        self.assertEqual(slowest.top(), [(9, "q9", "mysql"),
+                (9, "q9", "mysql"), (7, "q7", "mysql")])
+
+    @mock.patch.dict(os.environ, {"COLUMNS": "10", "LINES": "4"})
+    def testScreen(self):
+        class TTY(StringIO):
+            def isatty(self):
+                return True
+
+        out = TTY()
+        screen = Screen(out)
+        with screen.frame():
+            print("first line, cropped")
+            print("second")
+            # the colors take no room on the terminal
+            print("\033[31mthird\033[0m line, cropped")
+        self.assertEqual(out.getvalue(), "\033[H\033[2J"
+                "\033[1;1Hfirst line\033[K\033[2;1Hsecond\033[K"
+                "\033[3;1H\033[31mthird\033[0m line\033[0m\033[K\033[4;1H")
+
+        out.truncate(0)
+        out.seek(0)
+        screen.render("first line\n2nd")
+        # only the changed lines are redrawn, the leftovers are cleared
+        self.assertEqual(out.getvalue(), "\033[2;1H2nd\033[K"
+                "\033[3;1H\033[J\033[3;1H")
+
+        out.truncate(0)
+        out.seek(0)
+        screen.render("1\n2\n3\n4")
+        # taller than the terminal: printed as it is, so the tail is visible
+        self.assertEqual(out.getvalue(), "1\n2\n3\n4\n")
+
+        out.truncate(0)
+        out.seek(0)
+        screen.render("1")
+        self.assertEqual(out.getvalue(), "\033[H\033[2J\033[1;1H1\033[K"
+                "\033[2;1H")
+
+    def testDiagnoseJSON(self):
+        ps = {'Processes': [{'ID': 1, 'PID': 100,
+                'Type': 'SIP receiver udp:127.0.0.1:5060'}]}
+        ticks = iter([(100, 1, 95), (200, 31, 95)])
+
+        def execute(cmd, params=None, silent=False, handler=None):
+            if cmd == 'ps':
+                return ps
+            total, slow, shm = next(ticks)
+            return {'core:rcv_requests': str(total),
+                    'core:rcv_replies': '0',
+                    'core:slow_messages': str(slow),
+                    'load:load-proc-1': '10',
+                    'shmem:total_size': '100',
+                    'shmem:real_used_size': str(shm),
+                    'shmem:max_used_size': str(shm)}
+
+        out = StringIO()
+        diag = diagnose()
+        with mock.patch('opensipscli.comm.execute', execute), \
+                mock.patch('opensipscli.modules.diagnose.have_psutil', False), \
+                mock.patch.object(diag, 'startThresholdCollector',
+                        return_value=False), \
+                mock.patch('sys.stdout', out):
+            ret = diag.diagnose_json(None, {'--count': '2', '--interval': '0'})
+        ticks = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(ticks), 2)
+        # the first tick covers the counters since startup, then the deltas
+        self.assertEqual(ticks[0]['panels']['sip']['percentage'], 1)
+        self.assertEqual(ticks[1]['panels']['sip']['slow'], 30)
+        self.assertEqual(ticks[1]['panels']['sip']['severity'], "WARNING")
+        self.assertEqual(ticks[1]['panels']['memory']['severity'], "CRITICAL")
+        self.assertIsNone(ticks[1]['panels']['dns'])
+        self.assertEqual(ticks[1]['severity'], "CRITICAL")
+        self.assertEqual(ret, 2)
+
+    def testDiagnoseReplay(self):
+        answers = {'ps': {'Processes': []},
+                'get_statistics': {'dns:dns_total_queries': '10',
+                    'dns:dns_slow_queries': '2'}}
+        path = os.path.join(tempfile.mkdtemp(), "session.gz")
+        with mock.patch('opensipscli.comm.execute',
+                lambda cmd, params=None, silent=False: answers[cmd]):
+            recorder = SessionRecorder(path)
+            recorder.execute('ps')
+            recorder.event({'source': 'dns', 'time': 700,
+                'extra': 'sipdomain.invalid'})
+            recorder.execute('get_statistics', {'statistics': ['dns:']})
+            recorder.close()
+
+        out = StringIO()
+        with mock.patch('opensipscli.comm.execute') as execute, \
+                mock.patch('sys.stdout', out):
+            # the modifiers taking a value may be split from it
+            mod = diagnose()
+            cli = mock.Mock(modules={'diagnose': (mod, mod.__get_methods__())})
+            _, cmd, modifiers, params = OpenSIPSCLI.parse_command(cli,
+                    ['diagnose', '--json', '--replay', path, '--speed', '100',
+                        'dns'])
+            self.assertEqual((cmd, params), ('dns', []))
+            ret = mod.__invoke__(cmd, params, modifiers)
+            # nothing is asked from a live OpenSIPS
+            execute.assert_not_called()
+        tick, = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(tick['panels']['dns']['percentage'], 20)
+        self.assertEqual(tick['slowest'], [{'source': 'dns', 'time': 700,
+            'info': 'sipdomain.invalid'}])
+        self.assertEqual(ret, 1)
+
+    def testMemoryTrend(self):
+        leaking = MemoryTrend(50)
+        stable = MemoryTrend(50)
+        for ts in range(1000):
+            # the window only keeps the last 50 samples
+            leaking.add(ts, 10000 + (ts if ts > 500 else 0) * 8, 100000)
+            stable.add(ts, 50000 + (ts % 7) * 100, 100000)
+        rate, ttx = leaking.growth()
+        self.assertAlmostEqual(rate, 8)
+        self.assertAlmostEqual(ttx, (100000 - 10000 - 999 * 8) / 8)
+        self.assertIsNone(stable.growth())
+
+    def testNetSockets(self):
+        import ipaddress, sys
+        self.assertEqual(parse_iface("udp:[2001:db8::1]:5060"),
+                ("udp", ipaddress.ip_address("2001:db8::1"), 5060))
+        if sys.byteorder != 'little':
+            return
+        self.assertEqual(decode_proc_addr("0100007F:13C4"),
+                (ipaddress.ip_address("127.0.0.1"), 5060))
+        self.assertEqual(decode_proc_addr(
+                "B80D0120000000000000000001000000:13C4"),
+                (ipaddress.ip_address("2001:db8::1"), 5060))
+
+    def testProcSampler(self):
+        sampler = ProcSampler()
+        pid = os.getpid()
+        self.assertEqual(sampler.sample([pid, -1]), {})
+        sum(range(100000))
+        sample = sampler.sample([pid, -1])
+        # processes not running on this host are skipped
+        self.assertEqual(list(sample.keys()), [pid])
+        self.assertGreaterEqual(sample[pid]['cpu'], 0)
+        self.assertGreater(sample[pid]['rss'], 0)
+
+    def testAdvisePoolSize(self):
+        mb = 1024 * 1024
+        # too small for its peak usage, plus headroom
+        self.assertEqual(advise_pool_size(64 * mb, 60 * mb, 50), 90)
+        self.assertIsNone(advise_pool_size(64 * mb, 30 * mb, 50))
+        # way oversized
+        self.assertEqual(advise_pool_size(1024 * mb, 10 * mb, 50), 15)
+
+    def testAdviseScaleOut(self):
+        # 8 workers at 40% CPU keep 3.2 of 8 cores busy, below a 50% target
+        self.assertFalse(advise_scale_out(8 * 40 / 100, 8, 50))
+        # 8 workers at 60% CPU keep 4.8 of 8 cores busy, over a 50% target
+        self.assertTrue(advise_scale_out(8 * 60 / 100, 8, 50))
+        self.assertFalse(advise_scale_out(4.0, 8, 50))
+
+    def testTrapTimeout(self):
+        self.assertEqual(trap().run_gdb(["echo", "bt"], 5), "bt\n")
+        start = time.time()
+        with mock.patch('opensipscli.modules.trap.logger'):
+            self.assertIsNone(trap().run_gdb(["sleep", "10"], 0.2))
+        # the hung process is killed
+        self.assertLess(time.time() - start, 5)
+
+    def testBacktraceSummary(self):
+        lock = ("#0  0x00007f12 in __lll_lock_wait () from /lib/libc.so.6\n"
+                "#1  0x000055{} in db_mysql_submit_query (_h=0x55{}) at dbase.c:1\n"
+                "        i = {}\n"
+                "#2  <signal handler called>\n")
+        self.assertEqual(backtrace_frames(lock.format(1, 2, 3)),
+            ["__lll_lock_wait", "db_mysql_submit_query", "<signal handler called>"])
+        summary = backtrace_summary([(pid, backtrace_frames(output))
+            for pid, output in [("10", lock.format(1, 2, 3)),
+            ("11", "#0  main () at main.c:1\n"), ("12", lock.format(4, 5, 6))]])
+        self.assertEqual(summary, [
+            "2 processes in __lll_lock_wait <- db_mysql_submit_query <- "
+            "<signal handler called>: 10, 12",
+            "1 process in main: 11"])
+
+    def testFoldStack(self):
+        self.assertEqual(fold_stack(["epoll_wait", "udp_rcv_loop", "main"],
+            "UDP receiver"), "UDP receiver;main;udp_rcv_loop;epoll_wait")
+        self.assertEqual(fold_stack(["f;g", "main"]), "main;f:g")
+
+    def testProcState(self):
+        state = read_proc_state(os.getpid())
+        self.assertIn(state['state'], "RSD")
+        self.assertGreaterEqual(state['cpu_ticks'], 0)
+        self.assertIsNone(read_proc_state(2 ** 30))
+
+        # a process blocked in read(), which is syscall 0 on x86_64
+        proc = {
+            "stat": "42 (opensips) S 1 42 42 0 -1 0 0 0 0 0 7 3 0 0 20 0 1 0 9",
+            "wchan": "0",
+            "syscall": "0 0x5 0x7ffd 0x1000 0x0 0x0 0x0 0x7ffd 0x7f12",
+        }
+        def proc_open(path, *args, **kwargs):
+            return StringIO(proc[os.path.basename(path)])
+        with mock.patch('opensipscli.modules.trap.open', proc_open,
+                create=True):
+            state = read_proc_state(42)
+        self.assertEqual(state, {'state': 'S', 'cpu_ticks': 10,
+            'wchan': None, 'syscall': '0'})
+
+    def testProcInfo(self):
+        pid = str(os.getpid())
+        with open("/proc/self/comm") as f:
+            self.assertIn(pid, find_process_pids(f.read().strip()))
+        info = read_proc_info([pid, str(2 ** 30)])
+        self.assertIn("ppid={} ".format(os.getppid()), info[pid])
+        self.assertEqual(info[str(2 ** 30)], "UNKNOWN")
+
+    def testGdbString(self):
+        self.assertEqual(gdb_string('#4  receive_msg (buf=0x55 "INV")\n'
+            '$2 = 0x55 "INVITE sip:a@b SIP/2.0\\r\\nTo: \\"b\\"\\r\\n"\n'),
+            'INVITE sip:a@b SIP/2.0\r\nTo: "b"\r\n')
+        self.assertEqual(gdb_string("$1 = \"UDP receiver\", '\\000' "
+            "<repeats 40 times>"), "UDP receiver")
+        self.assertIsNone(gdb_string("No symbol \"pt\" in current context."))
+
+    def testTrapSingleGdb(self):
+        t = trap()
+        # the second process hangs, the session is restarted for the third
+        sessions = [
+            "printf '\\n---trap-pid 1\\nbt 1\\n---trap-pid 2\\n'; sleep 10",
+            "printf '\\n---trap-pid 3\\nbt 3\\n---trap-pid end\\n'",
+        ]
+        with mock.patch.object(t, 'gdb_session_cmd',
+                side_effect=lambda p, pids: ["sh", "-c", sessions.pop(0)]), \
+                mock.patch('opensipscli.modules.trap.logger'):
+            outputs = dict(t.gdb_session("opensips", ["1", "2", "3"], 0.5))
+        self.assertEqual(outputs, {"1": "bt 1\n", "2": None, "3": "bt 3\n"})
+
 
 if __name__ == "__main__":
     unittest.main()